@@ -1,4 +1,5 @@
 import os
+import time
 
 import requests
 from invoke import task
@@ -62,6 +63,21 @@ def calc_chart_data_task(_):
     return charts
 
 
+@task(init_app)
+def run_charts_worker(_, interval=30):
+    # Standalone charts worker, for web workers that run with CHARTS_PRECOMPUTE=standalone
+    from slots_tracker_server import app
+    from slots_tracker_server.charts import precompute_charts
+    print(f'Checking for charts to calculate every {interval} seconds')
+    while True:
+        try:
+            precompute_charts()
+        except Exception as e:
+            # Keep the worker running, the charts are calculated again on the next check
+            app.logger.error(f'Charts precompute failed: {e}')
+        time.sleep(int(interval))
+
+
 # Keep alive - prevent Heroku sleep
 @task(init_app)
 def keep_server_alive(_):
@@ -100,5 +116,8 @@ def read_expenses_from_files(c, settings='dev'):
 
     print(f'Total number of new expenses: {total_new_expenses}')
     print(f'Total number of new categories: {total_new_categories}')
+    # Persist the charts of the new data, the monthly update and the web app use them
+    from slots_tracker_server.charts import precompute_charts
+    precompute_charts()
     from slots_tracker_server.views import monthly_update
     monthly_update()
@@ -5,7 +5,7 @@ import datetime
 import os
 from itertools import chain
 
-from invoke import task
+from invoke import task, Exit
 from progress.bar import Bar
 
 from pyinvoke.base import init_app
@@ -71,16 +71,65 @@ def add_count_to_ref_fields(c, settings=None):
     init_app(c, settings=settings)
     from slots_tracker_server.models import Expense
 
-    # TODO: Change this so it will make changes based on chain(PayMethods.objects(), Categories.objects()
-    # Now we repeat this process to many times
-    # expenses = Expense.objects()
-    # for expense in Bar('Resting').iter(expenses):
-    #     pass
-    # expense.update_reference_filed_count(reset=True)
+    # Set the counters to the number of expenses that use each reference
+    drifts = Expense.reconcile_reference_count(fix=True)
+    print(f'Updated {len(drifts)} counters')
 
-    expenses = Expense.objects()
-    for expense in Bar('Updating').iter(expenses):
-        expense.update_reference_filed_count()
+
+@task()
+def rebuild_rollups(c, settings=None):
+    init_app(c, settings=settings)
+    # Leave here tp prevent circular import
+    from slots_tracker_server.models import ExpenseRollup
+
+    print('Rebuilding expense rollups')
+    total_rollups = ExpenseRollup.rebuild()
+    print(f'Total number of rollups: {total_rollups}')
+
+
+@task()
+def build_indexes(c, settings=None, check=False):
+    init_app(c, settings=settings)
+    # Leave here tp prevent circular import
+    from slots_tracker_server import indexes
+
+    print('Building the indexes')
+    for collection_name, index_names in indexes.build_indexes().items():
+        print(f'{collection_name}: {", ".join(index_names)}')
+
+    print('Queries indexes')
+    collection_scans = []
+    for name, is_collection_scan, index_names in indexes.explain_queries():
+        print(f'{name}: {"COLLECTION SCAN" if is_collection_scan else ", ".join(index_names)}')
+        if is_collection_scan:
+            collection_scans.append(name)
+
+    if check and collection_scans:
+        raise Exit(f'Queries without an index: {", ".join(collection_scans)}', code=1)
+
+
+@task()
+def index_business_names(c, settings=None):
+    init_app(c, settings=settings)
+    # Leave here tp prevent circular import
+    from slots_tracker_server.models import BusinessNames
+
+    print('Indexing the expenses business names')
+    total_names = BusinessNames.rebuild()
+    print(f'Total number of business names: {total_names}')
+
+
+@task()
+def reconcile_counters(c, settings=None, fix=False):
+    init_app(c, settings=settings)
+    # Leave here tp prevent circular import
+    from slots_tracker_server.models import Expense
+
+    print('Comparing the references counters with the expenses')
+    drifts = Expense.reconcile_reference_count(fix=fix)
+    for name, obj_id, instances, actual_count in drifts:
+        print(f'{name} {obj_id}: counter is {instances}, used by {actual_count} expenses')
+    print(f'Total number of wrong counters: {len(drifts)}{", fixed" if fix and drifts else ""}')
 
 
 def get_db_info():
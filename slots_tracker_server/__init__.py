@@ -6,7 +6,7 @@ from mongoengine import connect
 from raven.contrib.flask import Sentry
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Cursor', 'ETag'])
 
 DB_HOST = os.environ.get('DB_HOST')
 DB_NAME = os.environ.get('DB_NAME')
@@ -1,12 +1,17 @@
 import abc
+import hashlib
 from distutils.util import strtobool
 
 from bson import json_util, ObjectId
-from flask import request
+from flask import request, abort
 from flask.views import MethodView
 from mongoengine import NotUniqueError, Q
+from werkzeug.http import quote_etag
 
 # from slots_tracker_server import gsheet
+from slots_tracker_server.db import CollectionVersion
+from slots_tracker_server.references import reference_cache, expand_references
+from slots_tracker_server.serializer import dumps
 from slots_tracker_server.utils import convert_to_object_id, clean_api_object
 
 
@@ -20,9 +25,57 @@ class BaseAPI(MethodView):
 
     def get(self, obj_id):
         object_id = convert_to_object_id(obj_id)
+        fields = self.get_fields()
+        if fields:
+            obj_data = self.api_class.objects(id=object_id, active=True).only(*fields).to_json()
+            if not obj_data:
+                abort(404)
+            self.select_fields(obj_data, fields)
+            return obj_data
+
         instance = self.api_class.objects.get_or_404(id=object_id)
         return [instance.to_json()]
 
+    def get_fields(self):
+        """
+        The requested fields (?fields=amount,category.name) by field name, None for all the fields.
+        Sub fields of a reference field select the fields of the referenced document.
+        """
+        requested_fields = request.args.get('fields')
+        if not requested_fields:
+            return None
+
+        fields = dict()
+        for field in requested_fields.split(','):
+            name, _, sub_field = field.strip().partition('.')
+            if name in ['', '_id', 'id']:
+                # The ID is always returned
+                continue
+            if name not in self.api_class.fields():
+                abort(400, f'{name} is not a field of {self.api_class.__name__}')
+
+            sub_fields = fields.setdefault(name, [])
+            if sub_field:
+                sub_fields.append(sub_field)
+
+        return fields or {'id': []}
+
+    @staticmethod
+    def select_fields(obj_data, fields):
+        """Remove the fields that were not requested, in place"""
+        if not fields:
+            return
+
+        for entry in obj_data:
+            for name in list(entry):
+                if name != '_id' and name not in fields:
+                    del entry[name]
+
+            for name, sub_fields in fields.items():
+                value = entry.get(name)
+                if sub_fields and isinstance(value, dict):
+                    entry[name] = {x: value[x] for x in ['_id'] + sub_fields if x in value}
+
     def post(self, obj_data):
         return self.api_class(**obj_data).save()
 
@@ -30,6 +83,7 @@ class BaseAPI(MethodView):
         instance = self.api_class.objects.get_or_404(id=obj_id)
         instance.active = False
         instance.save()
+        reference_cache.invalidate(self.api_class)
         return '', 200
 
     def put(self, obj_id, obj_data):
@@ -41,15 +95,28 @@ class BaseAPI(MethodView):
         instance.update(**obj_data)
         return instance.reload()
 
+    def get_list_etag(self, *document_types):
+        """Strong ETag of the list response, changes whenever one of the collections it uses is written to"""
+        document_types = (self.api_class,) + document_types
+        versions = CollectionVersion.get_versions(*[x._get_collection_name() for x in document_types])
+        return hashlib.sha1(f'{request.full_path}:{versions}'.encode()).hexdigest()
+
+    @staticmethod
+    def is_not_modified(etag):
+        return request.if_none_match.contains(etag)
+
     @staticmethod
     def get_obj_data():
         return json_util.loads(request.data)
 
+    @staticmethod
+    def is_expand_requested():
+        # expand=false returns the IDs of the reference fields instead of the referenced documents
+        return bool(strtobool(request.args.get('expand', 'true')))
+
     def objects_id_to_json(self, obj_data):
-        for name, document_type in self.api_class.get_all_reference_fields():
-            field_id = obj_data.get(name)
-            field_data_as_json = document_type.objects.get(id=field_id).to_json()
-            obj_data[name] = field_data_as_json
+        if self.is_expand_requested():
+            expand_references([obj_data], self.api_class)
 
     def reference_field_to_object_id(self, obj_data):
         for name, _ in self.api_class.get_all_reference_fields():
@@ -84,9 +151,18 @@ class BasicObjectAPI(BaseAPI):
 
     def get(self, obj_id):
         if obj_id:
-            obj_data = super(BasicObjectAPI, self).get(obj_id)
+            return dumps(super(BasicObjectAPI, self).get(obj_id)[0])
         else:
+            etag = self.get_list_etag()
+            headers = {'ETag': quote_etag(etag)}
+            if self.is_not_modified(etag):
+                return '', 304, headers
+
             filtered_objs = self.api_class.objects(active=True)
+            fields = self.get_fields()
+            if fields:
+                filtered_objs = filtered_objs.only(*fields)
+
             added_by_user = request.args.get('added_by_user')
             if added_by_user is not None:
                 added_by_user = bool(strtobool(added_by_user))
@@ -97,13 +173,16 @@ class BasicObjectAPI(BaseAPI):
                 filtered_objs = filtered_objs.filter(condition)
 
             obj_data = filtered_objs.order_by('-instances').to_json()
+            self.select_fields(obj_data, fields)
 
-        return json_util.dumps(obj_data[0] if obj_id else obj_data)
+            return dumps(obj_data), 200, headers
 
     def post(self, obj_data=None):
         obj_data = self.get_obj_data()
         try:
-            return json_util.dumps(super(BasicObjectAPI, self).post(obj_data).to_json()), 201
+            new_obj = super(BasicObjectAPI, self).post(obj_data)
+            reference_cache.invalidate(self.api_class)
+            return dumps(new_obj.to_json()), 201
         except NotUniqueError:
             return 'Name value must be unique', 400
 
@@ -115,13 +194,16 @@ class BasicObjectAPI(BaseAPI):
             if action == 'merge_categories':
                 user_added_categories = obj_data.get('user_added_categories')
                 not_user_added_categories = self.api_class.objects.get_or_404(id=obj_id)
-                return not_user_added_categories.merge_categories(cat_to_merge_into_id=user_added_categories)
+                res = not_user_added_categories.merge_categories(cat_to_merge_into_id=user_added_categories)
+                reference_cache.invalidate(self.api_class)
+                return res
             else:
                 raise Exception('Unsupported post action in categories')
         else:
             try:
                 new_expense_as_json = super(BasicObjectAPI, self).put(obj_id, obj_data).to_json()
+                reference_cache.invalidate(self.api_class)
                 self.objects_id_to_json(new_expense_as_json)
-                return json_util.dumps(new_expense_as_json)
+                return dumps(new_expense_as_json)
             except NotUniqueError:
                 return 'Name value must be unique', 400
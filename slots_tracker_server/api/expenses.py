@@ -1,12 +1,34 @@
-import copy
+from distutils.util import strtobool
 
-from bson import json_util
-from flask import request
-from mongoengine import Q
+from bson import ObjectId
+from dateutil.parser import parse
+from flask import request, abort
+from mongoengine import Q, ValidationError, FieldDoesNotExist
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import quote_etag
 
 from slots_tracker_server.api.base import BasicObjectAPI, BaseAPI
-from slots_tracker_server.models import Expense, PayMethods, Categories
-from slots_tracker_server.utils import next_payment_date
+from slots_tracker_server.db import BaseQuerySet
+from slots_tracker_server.models import Expense, PayMethods, Categories, BusinessNames, SUMMARY_GROUP_BY
+from slots_tracker_server.references import expand_references
+from slots_tracker_server.serializer import dumps, to_json_data
+from slots_tracker_server.utils import payment_dates, encode_cursor, decode_cursor, clean_api_object, start_of_day, \
+    next_day, convert_to_object_id
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_SEARCH_BUSINESS_NAMES = 1000
+# Sort order of one_time values, expenses that were added before one_time don't have it
+ONE_TIME_ORDER = {None: 0, False: 1, True: 2}
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+MAX_BULK_SIZE = 5000
+# Filter name: query keyword and value conversion, dates are compared by date only (including the last day)
+RANGE_FILTERS = {
+    'timestamp_from': ('timestamp__gte', lambda x: start_of_day(parse(x))),
+    'timestamp_to': ('timestamp__lt', lambda x: next_day(parse(x))),
+    'amount_min': ('amount__gte', float),
+    'amount_max': ('amount__lte', float),
+}
 
 
 class PayMethodsAPI(BasicObjectAPI):
@@ -20,73 +42,273 @@ class CategoriesAPI(BasicObjectAPI):
 class ExpenseAPI(BaseAPI):
     api_class = Expense
 
-    def __init__(self):
-        self.docs = dict()
-        for name, document_type in self.api_class.get_all_reference_fields():
-            self.docs[name] = document_type.objects.to_json()
-
-    @staticmethod
-    def get_full_doc_by_id(doc_id, docs):
-        # return filter(lambda x: x.get('_id') == doc_id, docs)
-
-        for doc in docs:
-            if doc.get('_id') == doc_id:
-                return doc
-
-    def update_value_for_doc(self, field, docs):
-        return self.get_full_doc_by_id(field, docs)
-
     def reference_fields_to_data(self, obj_data):
-        for name, _ in self.api_class.get_all_reference_fields():
-            for entry in obj_data:
-                entry[name] = self.update_value_for_doc(entry[name], self.docs[name])
+        if self.is_expand_requested():
+            expand_references(obj_data, self.api_class)
 
     def get_filters(self):
         conditions = Q(active=True)
 
-        filter_keywords = ['amount', 'pay_method', 'category', 'timestamp']
+        filter_keywords = ['amount', 'timestamp', 'group_id']
         for keyword in filter_keywords:
             filter_data = request.args.get(keyword)
             if filter_data:
                 conditions = conditions & Q(**{keyword: filter_data})
 
+        # One ID or a comma separated list of IDs
+        for keyword in ['pay_method', 'category']:
+            filter_data = request.args.get(keyword)
+            if filter_data:
+                ids = filter_data.split(',')
+                conditions = conditions & (Q(**{keyword: ids[0]}) if len(ids) == 1 else Q(**{f'{keyword}__in': ids}))
+
+        try:
+            for keyword, (query_keyword, to_value) in RANGE_FILTERS.items():
+                filter_data = request.args.get(keyword)
+                if filter_data:
+                    conditions = conditions & Q(**{query_keyword: to_value(filter_data)})
+        except ValueError:
+            abort(400, f'{keyword} is not valid')
+
+        business_name_prefix = request.args.get('business_name_prefix')
+        if business_name_prefix:
+            conditions = conditions & Q(business_name__startswith=business_name_prefix)
+
+        return conditions
+
+    @staticmethod
+    def get_page_size():
+        try:
+            limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            limit = 0
+
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            abort(400, f'limit must be a number between 1 and {MAX_PAGE_SIZE}')
+
+        return limit
+
+    @staticmethod
+    def get_cursor_filters(cursor):
+        # Expenses after the cursor in the (one_time, -timestamp, -id) order, old expenses without one_time are first
+        one_time, timestamp, obj_id = decode_cursor(cursor, size=3)
+        if one_time not in [None, False, True]:
+            abort(400, '{} is not a valid cursor'.format(cursor))
+
+        conditions = Q(one_time=one_time, timestamp__lt=timestamp) | \
+            Q(one_time=one_time, timestamp=timestamp, id__lt=obj_id)
+        next_values = [x for x in [False, True] if one_time is None or x > one_time]
+        if next_values:
+            conditions = conditions | Q(one_time__in=next_values)
         return conditions
 
     def get(self, obj_id):
         filters = self.get_filters()
         filtered_objs = self.api_class.objects(active=True)
+        headers = dict()
         if obj_id:
             filtered_objs = super(ExpenseAPI, self).get(obj_id)
         else:
+            # The expenses are returned with their references
+            reference_types = [document_type for _, document_type in self.api_class.get_all_reference_fields()]
+            etag = self.get_list_etag(*reference_types)
+            headers['ETag'] = quote_etag(etag)
+            if self.is_not_modified(etag):
+                return '', 304, headers
+
             if filters:
                 filtered_objs = filtered_objs.filter(filters)
 
-            filtered_objs = filtered_objs.limit(50).order_by('one_time', '-timestamp').to_json()
+            filtered_objs = self.get_page(filtered_objs, headers)
         # Translate all reference fields from ID to data
         self.reference_fields_to_data(filtered_objs)
+        self.select_fields(filtered_objs, self.get_fields())
+
+        return dumps(filtered_objs), 200, headers
+
+    @staticmethod
+    def sort_page(docs):
+        # Expenses in the (one_time, -timestamp, -id) order, expenses without one_time are first
+        docs = sorted(docs, key=lambda x: x['_id'], reverse=True)
+        docs.sort(key=lambda x: x['timestamp'], reverse=True)
+        docs.sort(key=lambda x: ONE_TIME_ORDER[x.get('one_time')])
+        return docs
+
+    def get_page(self, filtered_objs, headers, batch_conditions=None):
+        """
+        The expenses page of the request cursor and limit as JSON, the next page cursor is added to the headers.
+        With batch conditions, the page is merged from the page of each condition.
+        """
+        cursor = request.args.get('cursor')
+        if cursor:
+            filtered_objs = filtered_objs.filter(self.get_cursor_filters(cursor))
+
+        fields = self.get_fields()
+        if fields:
+            # The cursor is made of the sort fields
+            filtered_objs = filtered_objs.only(*fields, 'one_time', 'timestamp')
+
+        limit = self.get_page_size()
+        docs = []
+        for condition in batch_conditions or [Q()]:
+            docs.extend(filtered_objs.filter(condition).order_by('one_time', '-timestamp', '-id').limit(limit + 1)
+                        .as_pymongo())
+        if batch_conditions:
+            docs = self.sort_page(docs)
+
+        if len(docs) > limit:
+            last_doc = docs[limit - 1]
+            headers[NEXT_CURSOR_HEADER] = encode_cursor([last_doc.get('one_time'), last_doc['timestamp'],
+                                                         last_doc['_id']])
+        return BaseQuerySet.docs_to_json(docs[:limit])
+
+    def search(self):
+        """The filtered expenses of the business names that match the q words (by prefix), a page at a time"""
+        text = request.args.get('q', '')
+        if not text.strip():
+            abort(400, 'q is required')
 
-        return json_util.dumps(filtered_objs)
+        # Each batch of business names is a bounded, index backed query
+        name_conditions = [Q(business_name__in=names)
+                           for names in BusinessNames.search(text, batch_size=MAX_SEARCH_BUSINESS_NAMES)]
+        headers = dict()
+        if not name_conditions:
+            return dumps([]), 200, headers
+
+        filtered_objs = self.get_page(self.api_class.objects(self.get_filters()), headers, name_conditions)
+        self.reference_fields_to_data(filtered_objs)
+        self.select_fields(filtered_objs, self.get_fields())
+
+        return dumps(filtered_objs), 200, headers
+
+    def get_summary(self):
+        """Amounts summary of the filtered expenses between two dates (including), grouped by the group_by keys"""
+        group_by = [x for x in request.args.get('group_by', '').split(',') if x]
+        if any(x not in SUMMARY_GROUP_BY for x in group_by):
+            abort(400, f'group_by must be made of {list(SUMMARY_GROUP_BY)}')
+
+        conditions = self.get_filters()
+        try:
+            if request.args.get('from'):
+                start = parse(request.args['from'])
+                conditions = conditions & Q(timestamp__gte=start_of_day(start))
+            if request.args.get('to'):
+                conditions = conditions & Q(timestamp__lt=next_day(parse(request.args['to'])))
+        except ValueError:
+            abort(400, 'from and to must be dates')
+
+        return dumps(to_json_data(self.api_class.summarize(conditions, group_by)))
 
     def post(self, obj_data=None):
         new_expenses_as_json = self.create_multi_expenses()
         return new_expenses_as_json, 201
 
     def put(self, obj_id, obj_data=None):
+        if self.is_group_requested():
+            return self.update_group(obj_id)
+
         new_expenses_as_json = self.create_multi_expenses(obj_id=obj_id)
         return new_expenses_as_json
 
+    def delete(self, obj_id):
+        if self.is_group_requested():
+            self.api_class.update_group(self.get_group_id(obj_id), active=False)
+            return '', 200
+
+        return super(ExpenseAPI, self).delete(obj_id)
+
+    @staticmethod
+    def is_group_requested():
+        # group=true changes all the payments of the expense installments plan
+        return bool(strtobool(request.args.get('group', 'false')))
+
+    def get_group_id(self, obj_id):
+        expense = self.api_class.objects.get_or_404(id=convert_to_object_id(obj_id))
+        if not expense.group_id:
+            abort(400, 'The expense is not part of an installments plan')
+
+        return expense.group_id
+
+    def update_group(self, obj_id):
+        group_id = self.get_group_id(obj_id)
+        obj_data = self.get_obj_data()
+        clean_api_object(obj_data)
+        self.reference_field_to_object_id(obj_data)
+        # Each payment keeps its own date
+        obj_data.pop('timestamp', None)
+        obj_data.pop('group_id', None)
+
+        self.api_class.update_group(group_id, **obj_data)
+        group_expenses = self.api_class.objects(group_id=group_id).order_by('timestamp').to_json()
+        self.reference_fields_to_data(group_expenses)
+        return dumps(group_expenses)
+
+    def post_bulk(self):
+        """Create many expenses at once, the result of each expense is reported by its index"""
+        items = self.get_obj_data()
+        if not isinstance(items, list) or not 0 < len(items) <= MAX_BULK_SIZE:
+            abort(400, f'Expected a list of 1 to {MAX_BULK_SIZE} expenses')
+
+        # Validate all the expenses before writing any of them
+        results = dict()
+        docs_data = dict()
+        for i, item in enumerate(items):
+            try:
+                if not isinstance(item, dict):
+                    raise ValidationError('An expense must be an object')
+                clean_api_object(item)
+                self.reference_field_to_object_id(item)
+                expense = self.api_class(**item)
+                expense.validate()
+                docs_data[i] = expense.to_mongo().to_dict()
+            except (ValidationError, FieldDoesNotExist, HTTPException) as e:
+                results[i] = dict(index=i, status=400, error=getattr(e, 'description', None) or str(e))
+
+        for name, document_type in self.api_class.get_all_reference_fields():
+            ids = list({data[name] for data in docs_data.values()})
+            existing_ids = set(document_type.objects(id__in=ids).distinct('id')) if ids else set()
+            for i, data in list(docs_data.items()):
+                if data[name] not in existing_ids:
+                    results[i] = dict(index=i, status=400, error=f'{name} {data[name]} does not exist')
+                    del docs_data[i]
+
+        if docs_data:
+            self.api_class.insert_many(list(docs_data.values()))
+            new_expenses_as_json = BaseQuerySet.docs_to_json(docs_data.values())
+            self.reference_fields_to_data(new_expenses_as_json)
+            for i, new_expense_as_json in zip(docs_data, new_expenses_as_json):
+                results[i] = dict(index=i, status=201, expense=new_expense_as_json)
+
+        return dumps([results[i] for i in range(len(items))]), 201 if docs_data else 400
+
     def create_multi_expenses(self, obj_id=None):
         obj_data = self.get_obj_data()
         self.reference_field_to_object_id(obj_data)
 
-        new_expenses = []
-        payments = int(request.args.get('payments', 1))
-        payments_data = copy.deepcopy(obj_data)
-        payments_data['amount'] = self.calc_amount(payments_data.get('amount'), payments)
-        for i in range(payments):
-            payments_data['timestamp'] = next_payment_date(obj_data['timestamp'], payment=i)
-            new_expenses.append(self.create_doc(payments_data, obj_id))
-        return json_util.dumps(new_expenses)
+        # An existing expense is a single payment
+        payments = 1 if obj_id else int(request.args.get('payments', 1))
+        obj_data['amount'] = self.calc_amount(obj_data.get('amount'), payments)
+        timestamps = payment_dates(obj_data['timestamp'], payments)
+        if payments == 1:
+            obj_data['timestamp'] = timestamps[0]
+            return dumps([self.create_doc(obj_data, obj_id)])
+
+        return dumps(self.create_installments(obj_data, timestamps))
+
+    def create_installments(self, obj_data, timestamps):
+        """All the payments of an installments plan are inserted at once, with a shared group ID"""
+        expense = self.api_class(**obj_data)
+        expense.timestamp = timestamps[0]
+        expense.group_id = ObjectId()
+        expense.validate()
+
+        expense_data = expense.to_mongo().to_dict()
+        docs_data = [{**expense_data, 'timestamp': timestamp} for timestamp in timestamps]
+        self.api_class.insert_many(docs_data)
+
+        new_expenses_as_json = BaseQuerySet.docs_to_json(docs_data)
+        self.reference_fields_to_data(new_expenses_as_json)
+        return new_expenses_as_json
 
     @staticmethod
     def calc_amount(original_amount, payments):
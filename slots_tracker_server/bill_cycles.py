@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+
+BILL_CYCLE_DAY = 10
+MAX_BILL_CYCLE_DAY = 28
+
+
+class BillCycles:
+    """Bill cycles that start on the same day of every month"""
+
+    def __init__(self, bill_day: Optional[int] = None):
+        self.bill_day = bill_day or BILL_CYCLE_DAY
+        if not 1 <= self.bill_day <= MAX_BILL_CYCLE_DAY:
+            raise ValueError(f'Bill day must be between 1 and {MAX_BILL_CYCLE_DAY}, got {self.bill_day}')
+
+    def get_cycle_start(self, date: datetime) -> datetime:
+        cycle_start = datetime(date.year, date.month, self.bill_day)
+        if date.day < self.bill_day:
+            cycle_start -= relativedelta(months=+1)
+
+        return cycle_start
+
+    def get_cycles(self, today: datetime) -> Tuple[datetime, datetime, datetime, datetime]:
+        # The last full cycle and the current cycle, end dates are the last day of the cycle
+        start_cycle2 = self.get_cycle_start(today)
+        start_cycle1 = start_cycle2 - relativedelta(months=+1)
+        end_cycle1 = start_cycle2 - timedelta(days=1)
+        end_cycle2 = start_cycle2 + relativedelta(months=+1) - timedelta(days=1)
+
+        return start_cycle1, end_cycle1, start_cycle2, end_cycle2
+
+    def get_boundaries(self, first_day: np.datetime64, last_day: np.datetime64) -> np.ndarray:
+        """Start days of all the cycles between the two days, including the cycle of the first day"""
+        months = np.arange(first_day.astype('datetime64[M]') - 1, last_day.astype('datetime64[M]') + 1)
+        return months.astype('datetime64[D]') + np.timedelta64(self.bill_day - 1, 'D')
+
+    def assign(self, timestamps: np.ndarray) -> np.ndarray:
+        """The cycle start day (datetime64[D]) of each timestamp"""
+        days = np.asarray(timestamps).astype('datetime64[D]')
+        if not len(days):
+            return days
+
+        boundaries = self.get_boundaries(days.min(), days.max())
+        return boundaries[np.searchsorted(boundaries, days, side='right') - 1]
+
+
+def assign_bill_cycles(timestamps: np.ndarray, pay_methods: Optional[np.ndarray] = None,
+                       bill_days: Optional[Dict[str, int]] = None) -> np.ndarray:
+    """The cycle start day of each timestamp, by the bill day of its pay method (string IDs)"""
+    cycles = BillCycles().assign(timestamps)
+    if pay_methods is not None and bill_days:
+        timestamps = np.asarray(timestamps)
+        pay_methods = np.asarray(pay_methods, dtype=object)
+        for bill_day in set(bill_days.values()):
+            ids = [pay_method_id for pay_method_id, day in bill_days.items() if day == bill_day]
+            mask = np.isin(pay_methods, ids)
+            cycles[mask] = BillCycles(bill_day).assign(timestamps[mask])
+
+    return cycles
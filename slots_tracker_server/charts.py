@@ -1,15 +1,40 @@
 from datetime import datetime
 import json
-from typing import Dict, Any, List, Union, Optional
+import os
+from typing import Dict, Any, List, Union, Optional, Tuple
 
+import numpy as np
 import pandas as pd
+from bson import ObjectId
+from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
+from flask import abort
 
 from slots_tracker_server import app
-from slots_tracker_server.models import Expense, Categories, PayMethods
-from slots_tracker_server.utils import get_bill_cycles
+from slots_tracker_server.cache import TTLCache
+from slots_tracker_server.db import CollectionVersion
+from slots_tracker_server.models import Expense, Categories, PayMethods, ExpenseRollup, ChartsSnapshot
+from slots_tracker_server.precompute import DebouncedTask, get_precompute_mode, THREAD_MODE, OFF_MODE
+from slots_tracker_server.bill_cycles import assign_bill_cycles
+from slots_tracker_server.time_index import time_indexes, GROUP_BY_FIELDS
+from slots_tracker_server.utils import get_bill_cycles, get_bill_cycle_start, next_day
 
 NUM_OF_CHARTS = 3
+NUMBER_OF_MONTHS = 6
+
+PANDAS_ENGINE = 'pandas'
+AGGREGATION_ENGINE = 'aggregation'
+ROLLUPS_ENGINE = 'rollups'
+CHARTS_ENGINES = [PANDAS_ENGINE, AGGREGATION_ENGINE, ROLLUPS_ENGINE]
+CHARTS_ENGINE_ENV_NAME = 'CHARTS_ENGINE'
+
+CHARTS_CACHE_SIZE = 32
+CHARTS_CACHE_TTL = 10 * 60
+charts_cache = TTLCache(max_size=CHARTS_CACHE_SIZE, ttl=CHARTS_CACHE_TTL)
+CHARTS_PRECOMPUTE_DEBOUNCE = 5
+
+RANGE_CHART_ARGS = ['from', 'to', 'granularity', 'group_by']
+GRANULARITIES = dict(day='D', week='W-MON', month='MS', cycle=None)
 
 
 def print_date(date):
@@ -17,8 +42,112 @@ def print_date(date):
     return date.strftime(date_format)
 
 
+def get_charts_engine(engine: Optional[str] = None) -> str:
+    return engine or os.environ.get(CHARTS_ENGINE_ENV_NAME, AGGREGATION_ENGINE)
+
+
+def get_charts_cache_key(engine: Optional[str] = None) -> Tuple[Any, ...]:
+    # The charts windows are based on the bill cycle and on today (future payments), data changes bump the versions
+    today = datetime.today()
+    start_cycle1 = get_bill_cycles(today)[0]
+    versions = CollectionVersion.get_versions(*[x._get_collection_name() for x in [Expense, Categories, PayMethods]])
+    return (get_charts_engine(engine), start_cycle1, today.date()) + versions
+
+
+def precompute_charts(engine: Optional[str] = None) -> Optional[str]:
+    # Calculate and persist the charts of the current data, unless they were already persisted
+    key = get_charts_cache_key(engine)
+    snapshot = ChartsSnapshot.objects(key=str(key)).first()
+    if snapshot:
+        charts_data = snapshot.data
+    else:
+        charts_data = Charts(engine).clac_charts()
+        ChartsSnapshot.store(key=str(key), engine=get_charts_engine(engine), data=charts_data)
+
+    charts_cache.set(key, charts_data)
+    return charts_data
+
+
+charts_precomputer = DebouncedTask(precompute_charts, debounce=CHARTS_PRECOMPUTE_DEBOUNCE)
+
+
+def schedule_charts_precompute() -> None:
+    if get_precompute_mode() == THREAD_MODE:
+        charts_precomputer.schedule()
+
+
+def get_charts(engine: Optional[str] = None) -> Optional[str]:
+    key = get_charts_cache_key(engine)
+    charts_data = charts_cache.get(key, default=False)
+    if charts_data is not False:
+        return charts_data
+
+    # While the charts of the current data are calculated in the background, serve the latest ones
+    if get_precompute_mode() != OFF_MODE and not ChartsSnapshot.objects(key=str(key)).first():
+        latest_snapshot = ChartsSnapshot.get_latest(get_charts_engine(engine))
+        if latest_snapshot:
+            schedule_charts_precompute()
+            return latest_snapshot.data
+
+    return precompute_charts(engine)
+
+
+def get_buckets(start: datetime, end: datetime, granularity: str) -> List[datetime]:
+    # The first bucket starts at the start date, the others on the granularity boundaries
+    if granularity == 'cycle':
+        bucket_start = get_bill_cycle_start(start)
+        boundaries = []
+        while bucket_start <= end:
+            boundaries.append(bucket_start)
+            bucket_start += relativedelta(months=+1)
+    else:
+        boundaries = pd.date_range(start, end, freq=GRANULARITIES[granularity]).to_pydatetime().tolist()
+
+    return [start] + [x for x in boundaries if start < x <= end]
+
+
+def get_range_charts(args: Dict[str, str]) -> str:
+    granularity = args.get('granularity', 'month')
+    group_by = args.get('group_by', 'category')
+    if granularity not in GRANULARITIES or group_by not in GROUP_BY_FIELDS:
+        abort(400, f'granularity must be one of {list(GRANULARITIES)} and group_by one of {GROUP_BY_FIELDS}')
+
+    try:
+        today = datetime.today()
+        end = parse(args['to']) if args.get('to') else today
+        start = parse(args['from']) if args.get('from') else end - relativedelta(months=+NUMBER_OF_MONTHS, day=1)
+    except ValueError:
+        abort(400, 'from and to must be dates')
+
+    start, end = datetime(start.year, start.month, start.day), datetime(end.year, end.month, end.day)
+    if start > end:
+        abort(400, 'from must be before to')
+
+    buckets = get_buckets(start, end, granularity)
+    boundaries = np.array(buckets + [next_day(end)], dtype='datetime64[D]')
+    group_sums = time_indexes[group_by].get_sums(boundaries)
+
+    names = dict()
+    if group_by == 'category':
+        names = Categories.get_summary()
+    elif group_by == 'pay_method':
+        names = PayMethods.get_summary()
+
+    date_format = '%B %Y' if granularity == 'month' else '%d/%m/%Y'
+    chart_data = pd.DataFrame({names.get(group, group): sums.round(1) for group, sums in group_sums.items()
+                               if sums.any()}, index=[x.strftime(date_format) for x in buckets])
+    chart_data = chart_data[chart_data.sum().sort_values(ascending=False).index]
+
+    title = f'All expenses by {group_by} - {print_date(start)} - {print_date(end)}'
+    return json.dumps([Charts.to_chart_data(title=title, series=chart_data, c_type='line')])
+
+
 class Charts:
-    def __init__(self):
+    def __init__(self, engine: Optional[str] = None):
+        self.engine = get_charts_engine(engine)
+        if self.engine not in CHARTS_ENGINES:
+            raise ValueError(f'Unsupported charts engine: {self.engine}')
+
         pd.set_option('precision', 3)
         self.ref_summary: Dict[str, Dict[str, str]] = {}
         self.expense_data: Optional[pd.DataFrame] = None
@@ -29,20 +158,45 @@ class Charts:
         self.charts: List[Any] = [None] * NUM_OF_CHARTS
         self.ref_fields_summary()
         self.start_cycle1, self.end_cycle1, self.start_cycle2, self.end_cycle2 = get_bill_cycles(self.today)
+        self.bill_days: Dict[str, int] = PayMethods.get_bill_days()
 
         self.last_month = None
-        self.last_month_dates = None
+        self.last_month_dates = f'{print_date(self.end_cycle1)} - {print_date(self.start_cycle1)}'
+        self.months_start_date: datetime = self.today - relativedelta(months=+NUMBER_OF_MONTHS, day=1, hour=0,
+                                                                       minute=0, second=0, microsecond=0)
+
+        # Engine output: last bill cycle amounts by category name and the expenses of the last months
+        self.last_month_by_category: Optional[pd.Series] = None
+        self.months_data: Optional[pd.DataFrame] = None
 
     def ref_fields_summary(self):
         methods_summary = PayMethods.get_summary()
         categories_summary = Categories.get_summary()
         self.ref_summary = dict(pay_method=methods_summary, category=categories_summary)
 
+    def get_last_cycles(self) -> List[Tuple[datetime, Dict[str, Any]]]:
+        # Start of the last bill cycle of the pay methods with the default bill day, and of each other bill day
+        pay_methods_by_bill_day: Dict[int, List[ObjectId]] = dict()
+        for pay_method_id, bill_day in self.bill_days.items():
+            pay_methods_by_bill_day.setdefault(bill_day, []).append(ObjectId(pay_method_id))
+
+        other_pay_methods = [x for ids in pay_methods_by_bill_day.values() for x in ids]
+        last_cycles = [(self.start_cycle1, {'pay_method': {'$nin': other_pay_methods}} if other_pay_methods else {})]
+        for bill_day, pay_methods in pay_methods_by_bill_day.items():
+            last_cycles.append((get_bill_cycles(self.today, bill_day)[0], {'pay_method': {'$in': pay_methods}}))
+
+        return last_cycles
+
     def is_db_empty(self):
         return self.expense_data.empty
 
     def get_expense_data(self):
-        self.expense_data = pd.DataFrame(Expense.objects().to_json())
+        if self.engine == AGGREGATION_ENGINE:
+            return self.get_aggregated_data()
+        elif self.engine == ROLLUPS_ENGINE:
+            return self.get_rollups_data()
+
+        self.expense_data = Expense.objects(active=True).to_frame('timestamp', 'amount', 'category', 'pay_method')
         if self.is_db_empty():
             app.logger.info('No data in DB, can not create charts')
             return None
@@ -50,16 +204,102 @@ class Charts:
         self.translate_expense_data()
         self.expense_data = self.expense_data[self.expense_data.timestamp <= self.today]
 
-        self.last_month = (self.expense_data.timestamp >= self.start_cycle1) & \
-                          (self.expense_data.timestamp <= self.end_cycle1)
-        self.last_month_dates = f'{print_date(self.end_cycle1)} - {print_date(self.start_cycle1)}'
+        pay_methods = np.asarray(self.expense_data.pay_method, dtype=object)
+        cycles = assign_bill_cycles(self.expense_data.timestamp.values, pay_methods, self.bill_days)
+        last_cycles = np.full(len(cycles), np.datetime64(self.start_cycle1, 'D'))
+        for pay_method_id, bill_day in self.bill_days.items():
+            last_cycles[pay_methods == pay_method_id] = np.datetime64(get_bill_cycles(self.today, bill_day)[0], 'D')
+        self.last_month = cycles == last_cycles
+        # Group by the categorical IDs, names are only used for the grouped labels
+        last_month_by_category = self.expense_data[self.last_month].groupby('category', observed=True).amount.sum()
+        self.last_month_by_category = self.to_category_names(last_month_by_category)
+
+        months_data = self.expense_data[self.expense_data.timestamp >= self.months_start_date]
+        self.months_data = months_data[['timestamp', 'amount']]
+
+        return True
+
+    def get_aggregated_data(self):
+        expenses = Expense.objects(active=True)
+        if expenses.only('id').first() is None:
+            app.logger.info('No data in DB, can not create charts')
+            return None
+
+        # Same windows as the pandas engine, which compares the expenses by date only
+        until = next_day(self.today)
+        last_cycles = self.get_last_cycles()
+        last_month_conditions = [
+            dict(condition, timestamp={'$gte': start, '$lt': min(start + relativedelta(months=+1), until)})
+            for start, condition in last_cycles
+        ]
+        pipeline = [
+            {'$facet': {
+                'last_month': [
+                    {'$match': {'$or': last_month_conditions}},
+                    {'$group': {'_id': '$category', 'amount': {'$sum': '$amount'}}},
+                ],
+                'months': [
+                    {'$match': {'timestamp': {'$gte': self.months_start_date}}},
+                    {'$group': {'_id': {'year': {'$year': '$timestamp'}, 'month': {'$month': '$timestamp'}},
+                                'amount': {'$sum': '$amount'}}},
+                ],
+            }},
+        ]
+
+        first_date = min([start for start, _ in last_cycles] + [self.months_start_date])
+        expenses = expenses.filter(timestamp__gte=first_date, timestamp__lt=until)
+        result = next(expenses.aggregate(pipeline))
+
+        months = [dict(_id=datetime(row['_id']['year'], row['_id']['month'], 1), amount=row['amount'])
+                  for row in result['months']]
+        self.set_grouped_data(last_month=result['last_month'], months=months)
+
+        return True
+
+    def get_rollups_data(self):
+        if Expense.objects(active=True).only('id').first() is None:
+            app.logger.info('No data in DB, can not create charts')
+            return None
+
+        # The last bill cycle is always over, the rollups of the current month can include future expenses
+        current_month = datetime(self.today.year, self.today.month, 1)
+        last_month_conditions = [dict(condition, cycle=start) for start, condition in self.get_last_cycles()]
+        last_month = ExpenseRollup.objects(count__gt=0).aggregate([
+            {'$match': {'$or': last_month_conditions}},
+            {'$group': {'_id': '$category', 'amount': {'$sum': '$amount'}}},
+        ])
+        months = list(ExpenseRollup.objects(month__gte=self.months_start_date, month__lt=current_month,
+                                            count__gt=0).aggregate([
+            {'$group': {'_id': '$month', 'amount': {'$sum': '$amount'}}},
+        ]))
+        current_month_expenses = Expense.objects(active=True, timestamp__gte=current_month,
+                                                 timestamp__lt=next_day(self.today))
+        for row in current_month_expenses.aggregate([{'$group': {'_id': None, 'amount': {'$sum': '$amount'}}}]):
+            months.append(dict(_id=current_month, amount=row['amount']))
+
+        self.set_grouped_data(last_month=last_month, months=months)
 
         return True
 
+    def set_grouped_data(self, last_month, months):
+        category_ids, amounts = [], []
+        for row in last_month:
+            category_ids.append(row['_id'])
+            amounts.append(row['amount'])
+        self.last_month_by_category = self.to_category_names(pd.Series(amounts, index=category_ids, dtype=float))
+
+        self.months_data = pd.DataFrame(dict(timestamp=pd.to_datetime([row['_id'] for row in months]),
+                                             amount=pd.Series([row['amount'] for row in months], dtype=float)))
+
+    def to_category_names(self, amounts: pd.Series) -> pd.Series:
+        # Amounts by category ID to amounts by category name, sorted by name
+        categories = self.ref_summary['category']
+        names = [categories.get(str(x), str(x)) for x in amounts.index]
+        return pd.Series(amounts.values, index=names, dtype=float).groupby(level=0).sum()
+
     def translate_expense_data(self):
-        self.expense_data.category.replace(to_replace=self.ref_summary['category'], inplace=True)
-        self.expense_data.pay_method.replace(to_replace=self.ref_summary['pay_method'], inplace=True)
-        self.expense_data.timestamp = pd.to_datetime(self.expense_data.timestamp, format='%Y-%m-%d')
+        # Expenses are compared by date only
+        self.expense_data.timestamp = self.expense_data.timestamp.dt.normalize()
 
     def clac_charts(self):
         if self.get_expense_data():
@@ -71,27 +311,24 @@ class Charts:
 
     def time_charts(self):
         # Chart 2 - All expenses - last month
-        temp = round(self.expense_data[self.last_month].groupby('category').sum().amount.sort_values(ascending=False), 1)  # noqa
+        temp = round(self.last_month_by_category.sort_values(ascending=False), 1)
         title = f'All expenses - last month ({self.last_month_dates}) - new'
         self.charts[1] = self.to_chart_data(series=temp, title=title)
 
         table = []
         # Chart 1 (table) - All expenses since the last 10th
         # All expenses in previous month (10th to 10th)
-        total = self.expense_data[self.last_month].amount.sum().round()
+        total = round(self.last_month_by_category.sum(), 0)
         title = f'All expenses in previous month ({self.last_month_dates})'
         table.append([title, total])
 
         self.charts[0] = self.to_chart_data(table=table, title=title, c_type='table')
 
         # Chart 3 - Total expenses by month
-        number_of_months = 6
-        start_date = self.today - relativedelta(months=+number_of_months, day=1, hour=0, minute=0, second=0, microsecond=0)
-        chart_data = self.expense_data[self.expense_data.timestamp >= start_date]
-        chart_data = chart_data.groupby(pd.Grouper(key='timestamp', freq='1M')).sum().round().amount
+        chart_data = self.months_data.groupby(pd.Grouper(key='timestamp', freq='1M')).sum().round().amount
 
         chart_data.index = chart_data.index.strftime('%B %Y')
-        title = 'All expenses by month - last 6 months - Total'
+        title = f'All expenses by month - last {NUMBER_OF_MONTHS} months - Total'
         self.charts[2] = self.to_chart_data(series=chart_data, title=title, c_type='line')
 
     def get_summary_table(self):
@@ -103,13 +340,17 @@ class Charts:
         return None
 
     @staticmethod
-    def to_chart_data(title: str, series: pd.Series = None, c_type: str = 'horizontalBar',
+    def to_chart_data(title: str, series: Union[pd.Series, pd.DataFrame] = None, c_type: str = 'horizontalBar',
                       table: List[List[Union[str, float]]] = None):
 
         if c_type in ['horizontalBar', 'line']:
             if series is not None:
                 labels: List[str] = series.index.tolist()
-                c_data: Dict[str, Any] = dict(labels=labels, datasets=[dict(data=series.values.tolist(), label='')])
+                if isinstance(series, pd.DataFrame):
+                    datasets = [dict(data=series[x].values.tolist(), label=x) for x in series.columns]
+                else:
+                    datasets = [dict(data=series.values.tolist(), label='')]
+                c_data: Dict[str, Any] = dict(labels=labels, datasets=datasets)
                 options: Dict[str, Any] = \
                     dict(scales=dict(xAxes=[dict(ticks=dict(autoSkip=False))]), title=dict(text=title, display=True),
                          maintainAspectRatio=False)
@@ -0,0 +1,93 @@
+import atexit
+import os
+from collections import Counter, defaultdict
+from threading import Lock, Timer
+from typing import Any, Dict, Optional, Type
+
+from pymongo import UpdateOne
+
+from slots_tracker_server import app
+from slots_tracker_server.db import BaseDocument
+
+FLUSH_INTERVAL_ENV_NAME = 'COUNTERS_FLUSH_INTERVAL'
+DEFAULT_FLUSH_INTERVAL = 5
+MAX_PENDING_COUNTERS = 100
+
+
+def get_flush_interval() -> float:
+    # Tests read the counters right after the writes, so they are written immediately
+    default_interval = 0 if os.environ.get('TESTING') == 'true' else DEFAULT_FLUSH_INTERVAL
+    return float(os.environ.get(FLUSH_INTERVAL_ENV_NAME, default_interval))
+
+
+class CounterBuffer:
+    """
+    Per process write behind buffer of the documents instances counters.
+    Changes are combined by document and written with atomic $inc, once there are `max_size` pending counters
+    or `interval` seconds after the first pending change.
+    """
+
+    def __init__(self, field: str = 'instances', max_size: int = MAX_PENDING_COUNTERS,
+                 interval: Optional[float] = None):
+        self.field = field
+        self.max_size = max_size
+        self.interval = get_flush_interval() if interval is None else interval
+        self.counts: Dict[Type[BaseDocument], Counter] = defaultdict(Counter)
+        self.timer: Optional[Timer] = None
+        self.lock = Lock()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(x) for x in self.counts.values())
+
+    def add(self, document_type: Type[BaseDocument], obj_id: Any, count: int = 1) -> None:
+        with self.lock:
+            self.counts[document_type][obj_id] += count
+            pending = sum(len(x) for x in self.counts.values())
+            flush_now = self.interval <= 0 or pending >= self.max_size
+            if not flush_now and (self.timer is None or not self.timer.is_alive()):
+                self.timer = Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if flush_now:
+            self.flush()
+
+    def restore(self, document_type: Type[BaseDocument], counts: Counter) -> None:
+        # Keep the changes that were not written for the next flush, with the changes that were added meanwhile
+        with self.lock:
+            self.counts[document_type].update(counts)
+            if self.interval > 0 and (self.timer is None or not self.timer.is_alive()):
+                self.timer = Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self) -> int:
+        """Write all the pending changes, returns the number of updated counters"""
+        with self.lock:
+            counts, self.counts = self.counts, defaultdict(Counter)
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        total = 0
+        for document_type, type_counts in counts.items():
+            updates = [UpdateOne({'_id': obj_id}, {'$inc': {self.field: count}})
+                       for obj_id, count in type_counts.items() if count]
+            if not updates:
+                continue
+
+            try:
+                document_type._get_collection().bulk_write(updates, ordered=False)
+            except Exception as e:
+                app.logger.error(f'Failed to write the {document_type.__name__} counters: {e}')
+                self.restore(document_type, type_counts)
+                continue
+            document_type.objects.bump_version()
+            total += len(updates)
+
+        return total
+
+
+counter_buffer = CounterBuffer()
+atexit.register(counter_buffer.flush)
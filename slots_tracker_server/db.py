@@ -1,9 +1,34 @@
-from bson import json_util
+from typing import Tuple, List, Any, Dict, Iterable
+
+import numpy as np
+import pandas as pd
 from flask import abort
-from mongoengine import Document, ReferenceField
+from mongoengine import Document, ReferenceField, StringField, IntField, DateTimeField, FloatField, BooleanField, \
+    ObjectIdField
 from mongoengine.queryset import DoesNotExist, QuerySet
+from pymongo import ReturnDocument
+
+from slots_tracker_server.serializer import to_json_data
+from slots_tracker_server.utils import object_id_to_str
+
+
+class CollectionVersion(Document):
+    """Write counter of a collection, used to know if data that was calculated from it is still valid"""
+    name = StringField(primary_key=True)
+    version = IntField(required=True, default=0)
+
+    meta = {'collection': 'collection_versions'}
+
+    @classmethod
+    def bump(cls, name: str) -> int:
+        version_data = cls._get_collection().find_one_and_update(
+            {'_id': name}, {'$inc': {'version': 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+        return version_data['version']
 
-from slots_tracker_server.utils import find_and_convert_object_id, find_and_convert_date, object_id_to_str
+    @classmethod
+    def get_versions(cls, *names: str) -> Tuple[int, ...]:
+        versions = {x['_id']: x['version'] for x in cls._get_collection().find({'_id': {'$in': list(names)}})}
+        return tuple(versions.get(name, 0) for name in names)
 
 
 class BaseQuerySet(QuerySet):
@@ -21,27 +46,80 @@ class BaseQuerySet(QuerySet):
         except DoesNotExist:
             abort(404)
 
+    def bump_version(self):
+        CollectionVersion.bump(self._document._get_collection_name())
+
+    def update(self, *args, **kwargs):
+        res = super(BaseQuerySet, self).update(*args, **kwargs)
+        self.bump_version()
+        return res
+
+    def delete(self, *args, **kwargs):
+        res = super(BaseQuerySet, self).delete(*args, **kwargs)
+        self.bump_version()
+        return res
+
+    def insert(self, *args, **kwargs):
+        res = super(BaseQuerySet, self).insert(*args, **kwargs)
+        self.bump_version()
+        return res
+
+    def to_frame(self, *fields: str) -> pd.DataFrame:
+        """
+        Load only the given fields as typed columns, skipping the documents and JSON conversions.
+        Reference fields are returned as categorical columns of the referenced IDs (as strings).
+        """
+        document_fields = self._document._fields
+        docs = list(self.only(*fields).as_pymongo())
+
+        columns = dict()
+        for name in fields:
+            field = document_fields[name]
+            values = [doc.get(field.db_field) for doc in docs]
+            columns[name] = self.to_column(field, values)
+
+        return pd.DataFrame(columns)
+
+    @staticmethod
+    def to_column(field, values: List[Any]):
+        if isinstance(field, DateTimeField):
+            return np.array(values, dtype='datetime64[ms]')
+        elif isinstance(field, (FloatField, IntField)):
+            return np.array(values, dtype=float)
+        elif isinstance(field, BooleanField):
+            return np.array(values, dtype=bool)
+        elif isinstance(field, (ReferenceField, ObjectIdField)):
+            categories = dict()
+            codes = np.fromiter((-1 if x is None else categories.setdefault(x, len(categories)) for x in values),
+                                dtype=np.int32, count=len(values))
+            return pd.Categorical.from_codes(codes, categories=[str(x) for x in categories])
+        else:
+            return np.array(values, dtype=object)
+
     def to_json(self, *args, **kwargs):
-        json_list = json_util.loads(super(BaseQuerySet, self).to_json())
-        temp = []
-        for json_obj in json_list:
-            find_and_convert_object_id(json_obj)
-            find_and_convert_date(json_obj)
-            temp.append(json_obj)
+        return self.docs_to_json(self.as_pymongo())
 
-        return temp
+    @staticmethod
+    def docs_to_json(docs: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [to_json_data(doc) for doc in docs]
 
 
 class BaseDocument(Document):
     _fields = None
-    meta = {'abstract': True, 'queryset_class': BaseQuerySet}
+    # Indexes are built without blocking the collection
+    meta = {'abstract': True, 'queryset_class': BaseQuerySet, 'index_background': True}
 
-    def to_json(self):
-        json_obj = json_util.loads(super(BaseDocument, self).to_json())
-        find_and_convert_object_id(json_obj)
-        find_and_convert_date(json_obj)
+    def save(self, *args, **kwargs):
+        doc = super(BaseDocument, self).save(*args, **kwargs)
+        CollectionVersion.bump(self._get_collection_name())
+        return doc
 
-        return json_obj
+    @classmethod
+    def get_version(cls) -> int:
+        return CollectionVersion.get_versions(cls._get_collection_name())[0]
+
+    def to_json(self):
+        return to_json_data(self.to_mongo())
 
     @classmethod
     def fields(cls):
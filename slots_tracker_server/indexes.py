@@ -0,0 +1,72 @@
+from datetime import datetime
+from typing import Any, Dict, List, Set, Tuple, Type
+
+from bson import ObjectId
+from mongoengine.queryset import QuerySet
+
+from slots_tracker_server.db import BaseDocument
+from slots_tracker_server.models import Expense, PayMethods, Categories, ExpenseRollup, BusinessNames, \
+    ChartsSnapshot, CategoryMatches
+
+INDEXED_MODELS: List[Type[BaseDocument]] = [PayMethods, Categories, Expense, ExpenseRollup, BusinessNames,
+                                            ChartsSnapshot, CategoryMatches]
+COLLECTION_SCAN = 'COLLSCAN'
+EXPENSES_LIST_ORDER = ('one_time', '-timestamp', '-id')
+
+
+def get_query_patterns() -> List[Tuple[str, QuerySet]]:
+    """The queries of the API and the models, with example values"""
+    obj_id, now = ObjectId(), datetime.utcnow()
+    expenses = Expense.objects(active=True)
+    return [
+        ('expenses list', expenses.order_by(*EXPENSES_LIST_ORDER)),
+        ('expenses by category', expenses.filter(category=obj_id).order_by(*EXPENSES_LIST_ORDER)),
+        ('expenses by categories', expenses.filter(category__in=[obj_id, ObjectId()]).order_by(*EXPENSES_LIST_ORDER)),
+        ('expenses by pay method', expenses.filter(pay_method=obj_id).order_by(*EXPENSES_LIST_ORDER)),
+        ('expenses by business names', expenses.filter(business_name__in=['a', 'b']).order_by(*EXPENSES_LIST_ORDER)),
+        ('expenses by business name prefix', expenses.filter(business_name__startswith='a')),
+        ('expenses by amount', expenses.filter(amount__gte=1, amount__lte=2)),
+        ('expenses by dates', expenses.filter(timestamp__gte=now, timestamp__lt=now).order_by(*EXPENSES_LIST_ORDER)),
+        ('installments plan', Expense.objects(group_id=obj_id)),
+        ('existing expenses by fingerprint', Expense.objects(fingerprint__in=['a', 'b'])),
+        ('existing expenses without a fingerprint',
+         Expense.objects(fingerprint=None, amount__in=[1, 2], timestamp__in=[now], pay_method__in=[obj_id])),
+        ('pay methods list', PayMethods.objects(active=True).order_by('-instances')),
+        ('categories list', Categories.objects(active=True).order_by('-instances')),
+        ('not user added categories', Categories.objects(active=True, added_by_user=False).order_by('-instances')),
+        ('category by name', Categories.objects(name='a')),
+        ('business names search', BusinessNames.objects(__raw__={'tokens': {'$regex': '^a'}})),
+        ('category matches of categories', CategoryMatches.objects(category__in=[obj_id])),
+        ('rollups by month', ExpenseRollup.objects(month__gte=now)),
+        ('latest charts snapshot', ChartsSnapshot.objects(engine='a').order_by('-created')),
+    ]
+
+
+def get_plan_stages(plan: Dict[str, Any], stages: Set[str], indexes: Set[str]) -> None:
+    stages.add(plan.get('stage'))
+    if plan.get('indexName'):
+        indexes.add(plan['indexName'])
+
+    for child in plan.get('inputStages', []) + [plan[x] for x in ['inputStage', 'queryPlan'] if x in plan]:
+        get_plan_stages(child, stages, indexes)
+
+
+def explain_queries() -> List[Tuple[str, bool, List[str]]]:
+    """The indexes each query uses (name, does a collection scan, index names)"""
+    results = []
+    for name, queryset in get_query_patterns():
+        stages, indexes = set(), set()
+        get_plan_stages(queryset.explain()['queryPlanner']['winningPlan'], stages, indexes)
+        results.append((name, COLLECTION_SCAN in stages, sorted(indexes)))
+
+    return results
+
+
+def build_indexes() -> Dict[str, List[str]]:
+    """Create the declared indexes of all the models (in the background), returns the index names by collection"""
+    indexes = dict()
+    for model in INDEXED_MODELS:
+        model.ensure_indexes()
+        indexes[model._get_collection_name()] = sorted(model._get_collection().index_information())
+
+    return indexes
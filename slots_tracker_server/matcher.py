@@ -0,0 +1,107 @@
+import math
+from collections import deque
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, Type
+
+from slots_tracker_server.db import BaseDocument
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton of keywords with a rank each.
+    Finds the lowest rank of the keywords contained in a text with one pass over the text.
+    """
+
+    def __init__(self, keywords: Dict[str, int]):
+        self.goto: List[Dict[str, int]] = [dict()]
+        self.fail: List[int] = [0]
+        # Lowest rank of the keywords that end in each state, including through the fail links
+        self.ranks: List[float] = [math.inf]
+
+        for keyword, rank in keywords.items():
+            self.add(keyword, rank)
+        self.build_fail_links()
+
+    def add(self, keyword: str, rank: int) -> None:
+        state = 0
+        for char in keyword:
+            if char not in self.goto[state]:
+                self.goto.append(dict())
+                self.fail.append(0)
+                self.ranks.append(math.inf)
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.ranks[state] = min(self.ranks[state], rank)
+
+    def build_fail_links(self) -> None:
+        # Breadth first, the fail state of each state is already set when its children are reached
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.ranks[next_state] = min(self.ranks[next_state], self.ranks[self.fail[next_state]])
+
+    def find_first(self, text: str) -> Optional[int]:
+        """The lowest rank of the keywords that are part of the text, None if there are none"""
+        state = 0
+        best = self.ranks[0]
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            best = min(best, self.ranks[state])
+
+        return None if best == math.inf else int(best)
+
+
+class CategoryMatcher:
+    """
+    Matcher of the businesses of all the categories, and their reversed form, ranked by the categories order.
+    The collection version is checked on every match, the automaton is built again only if the businesses changed.
+    """
+
+    def __init__(self, document_type: Type[BaseDocument]):
+        self.document_type = document_type
+        self.version: Optional[int] = None
+        self.businesses: List[Tuple[str, Tuple[str, ...]]] = []
+        self.matcher = KeywordMatcher(dict())
+        self.lock = Lock()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.version = None
+            self.businesses = []
+            self.matcher = KeywordMatcher(dict())
+
+    def refresh(self) -> None:
+        version = self.document_type.get_version()
+        if version == self.version:
+            return
+
+        categories = self.document_type._get_collection().find({'businesses.0': {'$exists': True}},
+                                                               {'name': 1, 'businesses': 1})
+        businesses = [(x['name'], tuple(x['businesses'])) for x in categories]
+        if businesses != self.businesses:
+            keywords = dict()
+            for rank, (_, values) in enumerate(businesses):
+                for value in values:
+                    keywords.setdefault(value, rank)
+                    keywords.setdefault(value[::-1], rank)
+            self.matcher = KeywordMatcher(keywords)
+            self.businesses = businesses
+        self.version = version
+
+    def match_many(self, business_names: List[str]) -> List[Optional[str]]:
+        """
+        The name of the first category with a business that is part of each business name,
+        the categories version is checked once
+        """
+        with self.lock:
+            self.refresh()
+            ranks = [self.matcher.find_first(x) for x in business_names]
+            return [None if rank is None else self.businesses[rank][0] for rank in ranks]
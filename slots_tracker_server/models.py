@@ -1,14 +1,69 @@
+import hashlib
+import re
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Callable, Tuple, Iterable, Set
+
 import mongoengine as db
-from mongoengine import DoesNotExist
+from mongoengine import Q
+import numpy as np
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError
 
 from slots_tracker_server import app
+from slots_tracker_server.bill_cycles import BILL_CYCLE_DAY, MAX_BILL_CYCLE_DAY, assign_bill_cycles
+from slots_tracker_server.cache import TTLCache
+from slots_tracker_server.counters import counter_buffer
 from slots_tracker_server.db import BaseDocument
+from slots_tracker_server.matcher import CategoryMatcher
+from slots_tracker_server.utils import get_bill_cycle_start, business_name_tokens, normalize_words
+
+# Called once per write (one expenses version bump) with the old and new data of the expenses it saved or updated
+EXPENSE_CHANGE_LISTENERS: List[Callable[[List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]], None]] = []
+# Expenses summary group by keys
+SUMMARY_GROUP_BY = {
+    'category': '$category',
+    'pay_method': '$pay_method',
+    'business_name': '$business_name',
+    'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$timestamp'}},
+    'month': {'$dateToString': {'format': '%Y-%m', 'date': '$timestamp'}},
+    'year': {'$year': '$timestamp'},
+}
+DUPLICATE_KEY_ERROR = 11000
+BUSINESS_CATEGORIES_CACHE_SIZE = 1024
+BUSINESS_CATEGORIES_CACHE_TTL = 5 * 60
+MAX_QUERY_VALUES = 1000
 
 
 class PayMethods(BaseDocument):
     name = db.StringField(required=True, max_length=200, unique=True)
     active = db.BooleanField(default=True)
     instances = db.IntField(required=True, default=0)
+    # Day of the month the bill cycle starts, the default bill day if not set
+    bill_day = db.IntField(min_value=1, max_value=MAX_BILL_CYCLE_DAY)
+
+    # List, most used first
+    meta = {'indexes': [('active', '-instances')]}
+
+    @classmethod
+    def get_bill_days(cls) -> Dict[str, int]:
+        # Only the pay methods with a bill day other than the default one
+        pay_methods = cls._get_collection().find({'bill_day': {'$nin': [None, BILL_CYCLE_DAY]}}, {'bill_day': 1})
+        return {str(x['_id']): x['bill_day'] for x in pay_methods}
+
+    def save(self, *args, **kwargs):
+        bill_day_changed = self.pk and 'bill_day' in self._get_changed_fields()
+        pay_method = super(PayMethods, self).save(*args, **kwargs)
+        if bill_day_changed:
+            ExpenseRollup.rebuild(pay_method_id=self.pk)
+        return pay_method
+
+    def update(self, **kwargs):
+        bill_day_changed = 'bill_day' in kwargs and kwargs['bill_day'] != self.bill_day
+        res = super(PayMethods, self).update(**kwargs)
+        if bill_day_changed:
+            ExpenseRollup.rebuild(pay_method_id=self.pk)
+        return res
 
 
 class Categories(BaseDocument):
@@ -19,6 +74,9 @@ class Categories(BaseDocument):
     parser_class = db.StringField(max_length=200)
     businesses = db.SortedListField(db.StringField(max_length=200))
 
+    # List, most used first (all or by added_by_user)
+    meta = {'indexes': [('active', '-instances'), ('active', 'added_by_user', '-instances')]}
+
     BUSINESS_IGNORE = ['colu', 'bit', 'box העברה באפליקציית', 'paypal', 'paybox']
 
     @staticmethod
@@ -27,38 +85,143 @@ class Categories(BaseDocument):
 
     @classmethod
     def guess_new_category(cls, business_name):
-        clean_business_name = business_name.replace('.', ' ').lower()
-        if cls.is_business_name_in_list(cls.BUSINESS_IGNORE, clean_business_name):
-            app.logger.info(f'business name: {business_name} is in ignore list')
-            return None
+        return cls.guess_new_categories([business_name])[business_name]
+
+    @classmethod
+    def guess_new_categories(cls, business_names: List[str]) -> Dict[str, Any]:
+        """The guessed category name of each business name, None for ignored names and False for unknown names"""
+        clean_business_names = {x: x.replace('.', ' ').lower() for x in business_names}
+        to_match = [x for x, clean_x in clean_business_names.items()
+                    if not cls.is_business_name_in_list(cls.BUSINESS_IGNORE, clean_x)]
+        matches = dict(zip(to_match, category_matcher.match_many([clean_business_names[x] for x in to_match])))
 
-        for category in cls.objects():
-            if cls.is_business_name_in_list(category.businesses, clean_business_name):
-                app.logger.info(f'business name: {business_name} is part of category: {category.name}')
-                return category.name
+        guesses = dict()
+        for business_name, clean_business_name in clean_business_names.items():
+            if business_name not in matches:
+                app.logger.info(f'business name: {business_name} is in ignore list')
+                guesses[business_name] = None
+            elif matches[business_name] is not None:
+                app.logger.info(f'business name: {business_name} is part of category: {matches[business_name]}')
+                guesses[business_name] = matches[business_name]
+            else:
+                print(f'Can not find group for {clean_business_name}, creating new category')
+                guesses[business_name] = False
 
-        print(f'Can not find group for {clean_business_name}, creating new category')
-        return False
+        return guesses
 
     @classmethod
     def get_or_create_category_by_business_name(cls, business_name):
-        is_new_category = False
-        try:
-            category = cls.objects.get(name=business_name)
-        except DoesNotExist:
-            category_name = cls.guess_new_category(business_name)
-
-            if category_name is None:
-                return False, is_new_category
-            elif category_name is False:
-                # Create new category
-                category = cls(name=business_name, added_by_user=False).save()
-                is_new_category = True
+        return cls.get_or_create_categories_by_business_names([business_name])[business_name]
+
+    @classmethod
+    def get_or_create_categories_by_business_names(cls, business_names: Iterable[str]) -> Dict[str, Tuple[Any, bool]]:
+        """
+        The category of each business name (False for ignored names) and if it was created.
+        Business names seen before are resolved from the in process cache, then from the stored matches.
+        The rest are resolved by the category name, then guessed by the businesses, and the categories of the
+        remaining names are created with one bulk upsert.
+        """
+        results = dict()
+        names = []
+        # Matches are removed, and their version bumped, whenever a category name or businesses change
+        version = CategoryMatches.get_version()
+        for name in set(business_names):
+            category = business_categories.get((version, name), default=False)
+            if category is False:
+                names.append(name)
             else:
-                # Find category by name
-                category = cls.objects.get(name=category_name)
+                results[name] = (category or False, False)
+        if not names:
+            return results
+
+        matches = {x['_id']: x['category'] for x in CategoryMatches._get_collection().find({'_id': {'$in': names}})}
+        matched_ids = [x for x in matches.values() if x]
+        matched_categories = {x.pk: x for x in cls.objects(id__in=matched_ids)} if matched_ids else dict()
+        unresolved = []
+        for name in names:
+            if name in matches and (matches[name] is None or matches[name] in matched_categories):
+                category = matched_categories.get(matches[name])
+                business_categories.set((version, name), category)
+                results[name] = (category or False, False)
+            else:
+                unresolved.append(name)
+        if not unresolved:
+            return results
+
+        categories = {x.name: x for x in cls.objects(name__in=unresolved)}
+        guesses = cls.guess_new_categories([name for name in unresolved if name not in categories])
+        guessed_names = {x for x in guesses.values() if x and x not in categories}
+        if guessed_names:
+            categories.update((x.name, x) for x in cls.objects(name__in=list(guessed_names)))
+        new_names = [name for name, guess in guesses.items() if guess is False]
+        created_categories, created_names = cls.create_not_user_added(new_names)
+        categories.update(created_categories)
+
+        new_matches = []
+        for name in unresolved:
+            # The category name, a guessed category name, False to create a category or None for ignored names
+            guess = guesses.get(name, name)
+            category = categories.get(guess or name) if guess is not None else None
+            if category is not None or guess is None:
+                new_matches.append((name, category, name in guesses and bool(guess)))
+            results[name] = (category or False, name in created_names)
+        CategoryMatches.store_many(new_matches)
+
+        if created_names:
+            version = CategoryMatches.get_version()
+        for name, category, _ in new_matches:
+            business_categories.set((version, name), category)
+
+        return results
+
+    @classmethod
+    def create_not_user_added(cls, names: List[str]) -> Tuple[Dict[str, 'Categories'], Set[str]]:
+        """
+        Get or create the not user added categories of the names, with one atomic upsert each, so parallel imports
+        don't fail on the unique name. Returns the categories by name and the names of the created categories.
+        """
+        if not names:
+            return dict(), set()
+
+        new_data = cls(added_by_user=False).to_mongo().to_dict()
+        updates = [UpdateOne({'name': name}, {'$setOnInsert': new_data}, upsert=True) for name in names]
+        try:
+            upserted_ids = cls._get_collection().bulk_write(updates, ordered=False).upserted_ids
+        except BulkWriteError as e:
+            # Categories created by a parallel import at the same time already exist now
+            if any(x['code'] != DUPLICATE_KEY_ERROR for x in e.details['writeErrors']):
+                raise
+            upserted_ids = {x['index']: x['_id'] for x in e.details['upserted']}
+
+        created_names = {names[i] for i in upserted_ids}
+        if created_names:
+            cls.objects.bump_version()
+            CategoryMatches.invalidate(names=created_names)
+
+        return {x.name: x for x in cls.objects(name__in=names)}, created_names
+
+    def save(self, *args, **kwargs):
+        is_new = not self.pk
+        changed_fields = [] if is_new else self._get_changed_fields()
+        category = super(Categories, self).save(*args, **kwargs)
+        if is_new:
+            CategoryMatches.invalidate(names=[self.name])
+        elif 'name' in changed_fields or 'businesses' in changed_fields:
+            CategoryMatches.invalidate(category_ids=[self.pk], names=[self.name],
+                                       guessed='businesses' in changed_fields)
+        return category
+
+    def update(self, **kwargs):
+        res = super(Categories, self).update(**kwargs)
+        if 'name' in kwargs or 'businesses' in kwargs:
+            CategoryMatches.invalidate(category_ids=[self.pk], names=[kwargs.get('name', self.name)],
+                                       guessed='businesses' in kwargs)
+        return res
 
-        return category, is_new_category
+    def delete(self, *args, **kwargs):
+        res = super(Categories, self).delete(*args, **kwargs)
+        CategoryMatches.invalidate(category_ids=[self.pk])
+        return res
 
     def merge_categories(self, cat_to_merge_into_id):
         if self.added_by_user or self.added_by_user is None:
@@ -68,13 +231,56 @@ class Categories(BaseDocument):
         if not cat_to_merge_into.added_by_user:
             raise Exception(f'Can not merge, {cat_to_merge_into.name} was not added by user')
 
-        Expense.objects.filter(category=self.id).update(multi=True, **{'category': cat_to_merge_into})
+        moved_expenses = Expense.objects.filter(category=self.id).update(multi=True, **{'category': cat_to_merge_into})
+        ExpenseRollup.move_category(self.id, cat_to_merge_into.id)
+        counter_buffer.add(Categories, cat_to_merge_into.id, moved_expenses)
         cat_to_merge_into.businesses.append(self.name)
         cat_to_merge_into.save()
         self.delete()
         return f'Category {self.name} was merged with {cat_to_merge_into.name}'
 
 
+category_matcher = CategoryMatcher(Categories)
+# Category document (None for ignored names) by the matches version and the business name, in front of CategoryMatches
+business_categories = TTLCache(max_size=BUSINESS_CATEGORIES_CACHE_SIZE, ttl=BUSINESS_CATEGORIES_CACHE_TTL)
+
+
+class CategoryMatches(BaseDocument):
+    """The category each business name was resolved to by its name or guessed by the businesses, None if ignored"""
+    business_name = db.StringField(primary_key=True)
+    category = db.ObjectIdField()
+    guessed = db.BooleanField(default=False)
+
+    meta = {'indexes': ['category', 'guessed']}
+
+    @classmethod
+    def store_many(cls, matches: List[Tuple[str, Optional[Categories], bool]]) -> None:
+        """Store the category of each business name and if it was guessed"""
+        updates = [ReplaceOne({'_id': name}, {'category': category.pk if category else None, 'guessed': guessed},
+                              upsert=True) for name, category, guessed in matches]
+        if updates:
+            cls._get_collection().bulk_write(updates, ordered=False)
+
+    @classmethod
+    def invalidate(cls, category_ids: Iterable[Any] = (), names: Iterable[str] = (), guessed: bool = False) -> None:
+        """
+        Remove the matches of the categories and of the business names, and all the guessed matches
+        when the businesses were changed
+        """
+        category_ids, names = list(category_ids), list(names)
+        conditions = [{'guessed': True}] if guessed else []
+        if category_ids:
+            conditions.append({'category': {'$in': category_ids}})
+        if names:
+            conditions.append({'_id': {'$in': names}})
+        if not conditions:
+            return
+
+        cls._get_collection().delete_many({'$or': conditions})
+        # Other processes stop using their cached categories
+        cls.objects.bump_version()
+
+
 class Expense(BaseDocument):
     amount = db.FloatField(required=True)
     pay_method = db.ReferenceField(PayMethods, required=True)
@@ -83,35 +289,385 @@ class Expense(BaseDocument):
     category = db.ReferenceField(Categories, required=True)
     business_name = db.StringField(max_length=200)
     one_time = db.BooleanField(default=False)
+    # Shared by all the payments of an installments plan
+    group_id = db.ObjectIdField()
+    # Identity of an imported expense, kept when the expense is edited so it is not imported again
+    fingerprint = db.StringField()
+
+    meta = {'indexes': [
+        # Expenses list, keyset pagination
+        {'fields': ['active', 'one_time', '-timestamp', '-id']},
+        {'fields': ['group_id'], 'sparse': True},
+        # Expenses list filters, a category / pay method (or a list of them) keeps the list order
+        {'fields': ['active', 'category', 'one_time', '-timestamp', '-id']},
+        {'fields': ['active', 'pay_method', 'one_time', '-timestamp', '-id']},
+        {'fields': ['active', 'business_name', 'one_time', '-timestamp', '-id']},
+        {'fields': ['active', 'amount']},
+        # Summary, covers the amounts by date, category and pay method
+        {'fields': ['active', 'timestamp', 'category', 'pay_method', 'amount']},
+        # Existing expenses without a fingerprint (get_existing)
+        {'fields': ['amount', 'timestamp', 'pay_method']},
+        {'fields': ['fingerprint'], 'unique': True, 'sparse': True},
+    ]}
 
     @classmethod
     def get_summary(cls):
         pass
 
     def save(self, **kwargs):
-        self.update_reference_filed_count()
-        return super(Expense, self).save(**kwargs)
+        old_data = self.get_stored_data() if self.pk else None
+        expense = super(Expense, self).save(**kwargs)
+        new_data = self.to_mongo()
+        self.update_reference_filed_count(old_data, new_data)
+        self.on_change(old_data=old_data, new_data=new_data)
+        return expense
 
     def update(self, **kwargs):
-        for name, cls in self.get_all_reference_fields():
-            ref_object = self.__getattribute__(name)
-            if ref_object.id != kwargs.get(name):
-                ref_object.instances -= 1
-                ref_object.save()
-                new_ref_object = cls.objects.get(id=kwargs.get(name))
-                new_ref_object.instances += 1
-                new_ref_object.save()
+        old_data = self.get_stored_data()
+        res = super(Expense, self).update(**kwargs)
+        new_data = self.get_stored_data()
+        self.update_reference_filed_count(old_data, new_data)
+        self.on_change(old_data=old_data, new_data=new_data)
+        return res
 
-        return super(Expense, self).update(**kwargs)
+    @classmethod
+    def insert_many(cls, docs_data: List[Dict[str, Any]]) -> List[Any]:
+        """
+        Insert validated new expenses (as mongo documents) at once, the documents are updated with their IDs.
+        The references instances counters are updated with one grouped write per reference type.
+        """
+        ids = cls._get_collection().insert_many(docs_data, ordered=True).inserted_ids
+        cls.objects.bump_version()
+        cls.inc_reference_count(docs_data)
+        cls.on_changes([(None, data) for data in docs_data])
+        return ids
+
+    @classmethod
+    def summarize(cls, conditions: Q, group_by: List[str]) -> List[Dict[str, Any]]:
+        """Total, count, min, max and average of the amounts of the expenses that match the conditions, by the keys"""
+        pipeline = [
+            {'$match': conditions.to_query(cls)},
+            {'$group': {'_id': {key: SUMMARY_GROUP_BY[key] for key in group_by} if group_by else None,
+                        'total': {'$sum': '$amount'}, 'count': {'$sum': 1}, 'min': {'$min': '$amount'},
+                        'max': {'$max': '$amount'}, 'average': {'$avg': '$amount'}}},
+            {'$sort': {'_id': 1}},
+        ]
 
-    def update_reference_filed_count(self):
-        for name, _ in self.get_all_reference_fields():
-            ref_object = self.__getattribute__(name)
-            ref_object.instances += 1
+        summary = []
+        for item in cls._get_collection().aggregate(pipeline):
+            keys = item.pop('_id') or dict()
+            summary.append({**keys, **item})
 
-            ref_object.save()
+        return summary
+
+    @classmethod
+    def update_group(cls, group_id, **kwargs) -> int:
+        """Update all the expenses of an installments plan, returns the number of updated expenses"""
+        collection = cls._get_collection()
+        old_docs = list(collection.find({'group_id': group_id}))
+        res = cls.objects(group_id=group_id).update(**kwargs)
+        new_docs = {doc['_id']: doc for doc in collection.find({'group_id': group_id})}
+
+        changes = [(old_data, new_docs.get(old_data['_id'])) for old_data in old_docs]
+        for old_data, new_data in changes:
+            cls.update_reference_filed_count(old_data, new_data)
+        cls.on_changes(changes)
+        return res
+
+    @staticmethod
+    def get_fingerprint(expense_data: Dict[str, Any]) -> str:
+        business_name = ' '.join(normalize_words(expense_data.get('business_name') or ''))
+        key = f'{expense_data["pay_method"]}|{expense_data["timestamp"].isoformat()}|' \
+              f'{round(float(expense_data["amount"]), 2)}|{business_name}'
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    @classmethod
+    def get_existing(cls, docs_data: List[Dict[str, Any]]) -> List[bool]:
+        """
+        If each expense (as mongo document) exists: an expense with its fingerprint, or an expense without
+        a fingerprint (added by the user or imported before the fingerprints) with its amount, timestamp and pay method
+        """
+        if not docs_data:
+            return []
+
+        collection = cls._get_collection()
+        fingerprints = [cls.get_fingerprint(data) for data in docs_data]
+        existing_fingerprints = {x['fingerprint'] for x in collection.find({'fingerprint': {'$in': fingerprints}},
+                                                                            {'fingerprint': 1})}
+
+        query = {'fingerprint': None}
+        for name in ['amount', 'timestamp', 'pay_method']:
+            query[name] = {'$in': list({data[name] for data in docs_data})}
+        existing_keys = {(x['amount'], x['timestamp'], x['pay_method'])
+                         for x in collection.find(query, {'amount': 1, 'timestamp': 1, 'pay_method': 1})}
+
+        return [fingerprint in existing_fingerprints or
+                (data['amount'], data['timestamp'], data['pay_method']) in existing_keys
+                for fingerprint, data in zip(fingerprints, docs_data)]
+
+    @classmethod
+    def upsert_many(cls, docs_data: List[Dict[str, Any]]) -> List[bool]:
+        """
+        Insert the validated expenses (as mongo documents) that were not inserted before, by their fingerprint,
+        with one bulk of atomic upserts. Returns if each expense was inserted,
+        the documents are updated with their fingerprint and the inserted ones with their IDs.
+        """
+        # Only the first expense of each fingerprint is written
+        fingerprints = set()
+        updates, update_indexes = [], []
+        for i, data in enumerate(docs_data):
+            data['fingerprint'] = cls.get_fingerprint(data)
+            if data['fingerprint'] in fingerprints:
+                continue
+            fingerprints.add(data['fingerprint'])
+            new_data = {k: v for k, v in data.items() if k != 'fingerprint'}
+            updates.append(UpdateOne({'fingerprint': data['fingerprint']}, {'$setOnInsert': new_data}, upsert=True))
+            update_indexes.append(i)
+        if not updates:
+            return []
+
+        error = None
+        try:
+            upserted_ids = cls._get_collection().bulk_write(updates, ordered=False).upserted_ids
+        except BulkWriteError as e:
+            # Expenses inserted by a parallel import at the same time already exist now
+            upserted_ids = {x['index']: x['_id'] for x in e.details['upserted']}
+            if any(x['code'] != DUPLICATE_KEY_ERROR for x in e.details['writeErrors']):
+                error = e
+
+        new_docs = []
+        inserted = set()
+        for i, obj_id in upserted_ids.items():
+            docs_data[update_indexes[i]]['_id'] = obj_id
+            new_docs.append(docs_data[update_indexes[i]])
+            inserted.add(update_indexes[i])
+
+        # The derived data of the expenses that were written is updated even if others failed
+        if new_docs:
+            cls.objects.bump_version()
+            cls.inc_reference_count(new_docs)
+            cls.on_changes([(None, data) for data in new_docs])
+        if error:
+            raise error
+
+        return [i in inserted for i in range(len(docs_data))]
+
+    @classmethod
+    def inc_reference_count(cls, docs_data: List[Dict[str, Any]]):
+        for name, document_type in cls.get_all_reference_fields():
+            counts = Counter(data[name] for data in docs_data)
+            updates = [UpdateOne({'_id': ref_id}, {'$inc': {'instances': count}}) for ref_id, count in counts.items()]
+            if updates:
+                document_type._get_collection().bulk_write(updates, ordered=False)
+                document_type.objects.bump_version()
+
+    @classmethod
+    def on_change(cls, old_data: Optional[Dict[str, Any]], new_data: Optional[Dict[str, Any]]):
+        cls.on_changes([(old_data, new_data)])
+
+    @staticmethod
+    def on_changes(changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]):
+        ExpenseRollup.apply_changes(changes)
+        BusinessNames.add(new_data['business_name'] for _, new_data in changes
+                          if new_data and new_data.get('business_name'))
+        for listener in EXPENSE_CHANGE_LISTENERS:
+            listener(changes)
+
+    def get_stored_data(self) -> Optional[Dict[str, Any]]:
+        return self._get_collection().find_one({'_id': self.pk})
+
+    @classmethod
+    def update_reference_filed_count(cls, old_data: Optional[Dict[str, Any]], new_data: Optional[Dict[str, Any]]):
+        # Count the expense in its references, and stop counting it in the references it was moved from
+        for name, document_type in cls.get_all_reference_fields():
+            old_id = old_data.get(name) if old_data else None
+            new_id = new_data.get(name) if new_data else None
+            if old_id == new_id:
+                continue
+
+            if old_id is not None:
+                counter_buffer.add(document_type, old_id, -1)
+            if new_id is not None:
+                counter_buffer.add(document_type, new_id, 1)
+
+    @classmethod
+    def reconcile_reference_count(cls, fix: bool = False) -> List[Tuple[str, Any, int, int]]:
+        """
+        Compare the references instances counters with the number of expenses that use them.
+        Returns the references with a wrong counter (name, ID, counter, actual count), and fix them if asked to.
+        """
+        counter_buffer.flush()
+        collection = cls._get_collection()
+        drifts = []
+        for name, document_type in cls.get_all_reference_fields():
+            actual_counts = {x['_id']: x['count'] for x in collection.aggregate([
+                {'$group': {'_id': f'${name}', 'count': {'$sum': 1}}}])}
+
+            updates = []
+            for ref_data in document_type._get_collection().find({}, {'instances': 1}):
+                instances = ref_data.get('instances', 0)
+                actual_count = actual_counts.get(ref_data['_id'], 0)
+                if instances != actual_count:
+                    drifts.append((document_type.__name__, ref_data['_id'], instances, actual_count))
+                    updates.append(UpdateOne({'_id': ref_data['_id']}, {'$set': {'instances': actual_count}}))
+
+            if fix and updates:
+                document_type._get_collection().bulk_write(updates, ordered=False)
+                document_type.objects.bump_version()
+
+        return drifts
 
     @classmethod
     def is_new_expense(cls, expense):
-        res = cls.objects.filter(amount=expense.amount, timestamp=expense.timestamp, pay_method=expense.pay_method)
-        return not bool(res)
+        return not cls.get_existing([expense.to_mongo().to_dict()])[0]
+
+
+class ExpenseRollup(BaseDocument):
+    """Total amount and number of active expenses per bill cycle, month, category and pay method"""
+    cycle = db.DateTimeField(required=True)
+    month = db.DateTimeField(required=True)
+    category = db.ReferenceField(Categories, required=True)
+    pay_method = db.ReferenceField(PayMethods, required=True)
+    amount = db.FloatField(required=True, default=0)
+    count = db.IntField(required=True, default=0)
+
+    meta = {'indexes': [{'fields': ['cycle', 'month', 'category', 'pay_method'], 'unique': True}, 'month']}
+
+    @staticmethod
+    def get_key(timestamp: datetime, category, pay_method, bill_day: Optional[int] = None) -> Dict[str, Any]:
+        return dict(cycle=get_bill_cycle_start(timestamp, bill_day), month=datetime(timestamp.year, timestamp.month, 1),
+                    category=category, pay_method=pay_method)
+
+    @classmethod
+    def apply_change(cls, old_data: Optional[Dict[str, Any]] = None, new_data: Optional[Dict[str, Any]] = None):
+        cls.apply_changes([(old_data, new_data)])
+
+    @classmethod
+    def apply_changes(cls, changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]):
+        # Remove the expenses old values and add the new ones, inactive expenses are not counted.
+        # Changes to the same rollup are combined into one update.
+        bill_days = PayMethods.get_bill_days()
+        deltas = defaultdict(lambda: [0.0, 0])
+        for old_data, new_data in changes:
+            for expense_data, sign in [(old_data, -1), (new_data, 1)]:
+                if expense_data and expense_data.get('active', True):
+                    pay_method = expense_data['pay_method']
+                    key = cls.get_key(expense_data['timestamp'], expense_data['category'], pay_method,
+                                      bill_days.get(str(pay_method)))
+                    delta = deltas[tuple(key.items())]
+                    delta[0] += sign * expense_data['amount']
+                    delta[1] += sign
+
+        updates = [UpdateOne(dict(key), {'$inc': {'amount': amount, 'count': count}}, upsert=True)
+                   for key, (amount, count) in deltas.items()]
+        if updates:
+            cls._get_collection().bulk_write(updates, ordered=False)
+
+    @classmethod
+    def move_category(cls, old_category_id, new_category_id):
+        collection = cls._get_collection()
+        updates = []
+        for rollup in collection.find({'category': old_category_id}):
+            key = dict(cycle=rollup['cycle'], month=rollup['month'], category=new_category_id,
+                       pay_method=rollup['pay_method'])
+            updates.append(UpdateOne(key, {'$inc': {'amount': rollup['amount'], 'count': rollup['count']}},
+                                     upsert=True))
+
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+        collection.delete_many({'category': old_category_id})
+
+    @classmethod
+    def rebuild(cls, pay_method_id=None) -> int:
+        # Group by day in the DB, the bill cycles of all the days are assigned at once
+        pipeline = [
+            {'$group': {
+                '_id': {'year': {'$year': '$timestamp'}, 'month': {'$month': '$timestamp'},
+                        'day': {'$dayOfMonth': '$timestamp'}, 'category': '$category', 'pay_method': '$pay_method'},
+                'amount': {'$sum': '$amount'}, 'count': {'$sum': 1}}},
+        ]
+
+        expenses = Expense.objects(active=True)
+        query = dict()
+        if pay_method_id:
+            expenses = expenses.filter(pay_method=pay_method_id)
+            query['pay_method'] = pay_method_id
+
+        rows = list(expenses.aggregate(pipeline))
+        days = np.array([datetime(x['_id']['year'], x['_id']['month'], x['_id']['day']) for x in rows],
+                        dtype='datetime64[D]')
+        pay_methods = [str(x['_id']['pay_method']) for x in rows]
+        cycles = assign_bill_cycles(days, pay_methods, PayMethods.get_bill_days())
+
+        rollups = dict()
+        for row, day, cycle in zip(rows, days.tolist(), cycles.tolist()):
+            group = row['_id']
+            key = dict(cycle=datetime(cycle.year, cycle.month, cycle.day), month=datetime(day.year, day.month, 1),
+                       category=group['category'], pay_method=group['pay_method'])
+            rollup = rollups.setdefault(tuple(key.values()), dict(key, amount=0, count=0))
+            rollup['amount'] += row['amount']
+            rollup['count'] += row['count']
+
+        collection = cls._get_collection()
+        collection.delete_many(query)
+        if rollups:
+            collection.insert_many(list(rollups.values()))
+
+        return len(rollups)
+
+
+class BusinessNames(BaseDocument):
+    """Search tokens of the expenses business names"""
+    name = db.StringField(primary_key=True)
+    tokens = db.ListField(db.StringField())
+
+    meta = {'indexes': ['tokens']}
+
+    @classmethod
+    def add(cls, names: Iterable[str]) -> None:
+        updates = [UpdateOne({'_id': name}, {'$setOnInsert': {'tokens': business_name_tokens(name)}}, upsert=True)
+                   for name in set(names)]
+        if updates:
+            cls._get_collection().bulk_write(updates, ordered=False)
+
+    @classmethod
+    def search(cls, text: str, batch_size: int) -> List[List[str]]:
+        """The business names with a token that starts with each of the text words, sorted, in batches"""
+        words = normalize_words(text)
+        if not words:
+            return []
+
+        query = {'$and': [{'tokens': {'$regex': f'^{re.escape(x)}'}} for x in words]}
+        names = [x['_id'] for x in cls._get_collection().find(query, {'_id': 1}).sort('_id', 1)]
+        return [names[i:i + batch_size] for i in range(0, len(names), batch_size)]
+
+    @classmethod
+    def rebuild(cls) -> int:
+        """Index the business names of the active expenses, and remove the names that are not used anymore"""
+        names = {x for x in Expense.objects(active=True).distinct('business_name') if x}
+        unused_names = list(set(cls._get_collection().distinct('_id')) - names)
+        for i in range(0, len(unused_names), MAX_QUERY_VALUES):
+            cls._get_collection().delete_many({'_id': {'$in': unused_names[i:i + MAX_QUERY_VALUES]}})
+        cls.add(names)
+        return len(names)
+
+
+class ChartsSnapshot(BaseDocument):
+    """Serialized charts, calculated for a charts cache key"""
+    key = db.StringField(primary_key=True)
+    engine = db.StringField(required=True)
+    data = db.StringField()
+    created = db.DateTimeField(required=True, default=datetime.utcnow)
+
+    meta = {'indexes': [('engine', '-created')]}
+
+    @classmethod
+    def store(cls, key: str, engine: str, data: Optional[str]):
+        # Only the latest snapshot of each engine is used, the older ones are removed
+        collection = cls._get_collection()
+        collection.replace_one({'_id': key}, dict(engine=engine, data=data, created=datetime.utcnow()), upsert=True)
+        collection.delete_many({'engine': engine, '_id': {'$ne': key}})
+
+    @classmethod
+    def get_latest(cls, engine: str) -> Optional['ChartsSnapshot']:
+        return cls.objects(engine=engine).order_by('-created').first()
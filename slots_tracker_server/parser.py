@@ -7,6 +7,7 @@ import re
 from abc import ABC, abstractmethod
 from pathlib import Path
 
+from slots_tracker_server.bill_cycles import BILL_CYCLE_DAY
 from slots_tracker_server.models import Expense, Categories, PayMethods
 from slots_tracker_server.utils import read_file, remove_new_lines
 
@@ -37,22 +38,43 @@ class ExpenseParser(ABC):
         self.bill_month = None
         self.new_categories = set()
         self.new_expenses = set()
+        self.parsed_expenses = []
 
     def process_new_expense(self, business_name, amount, date, is_payments, bill_date):
         expense = Expense(amount=amount, timestamp=date, business_name=business_name, pay_method=self.pay_method)
         if is_payments and bill_date and bill_date.month != expense.timestamp.month:
             expense.timestamp = bill_date
 
-        if not Expense.is_new_expense(expense):
-            return
-
-        category, is_new_category = Categories.get_or_create_category_by_business_name(business_name)
-        if category:
-            if is_new_category:
-                self.new_categories.add(business_name)
-            expense.category = category
-            expense.save()
-            self.new_expenses.add(expense)
+        self.parsed_expenses.append(expense)
+
+    def save_new_expenses(self):
+        # Expenses that exist are dropped first, so no categories are created for them
+        docs_data = [expense.to_mongo().to_dict() for expense in self.parsed_expenses]
+        parsed_expenses = [expense for expense, exists in zip(self.parsed_expenses, Expense.get_existing(docs_data))
+                           if not exists]
+
+        # The categories of all the business names are resolved at once, expenses of ignored businesses are dropped
+        categories = Categories.get_or_create_categories_by_business_names(
+            expense.business_name for expense in parsed_expenses)
+        expenses = []
+        for expense in parsed_expenses:
+            category, is_new_category = categories[expense.business_name]
+            if category:
+                if is_new_category:
+                    self.new_categories.add(expense.business_name)
+                expense.category = category
+                expense.validate()
+                expenses.append(expense)
+
+        # Expenses imported at the same time by another import are skipped by their fingerprint
+        docs_data = [expense.to_mongo().to_dict() for expense in expenses]
+        for expense, expense_data, is_new in zip(expenses, docs_data, Expense.upsert_many(docs_data)):
+            if is_new:
+                expense.id = expense_data['_id']
+                expense.fingerprint = expense_data['fingerprint']
+                self.new_expenses.add(expense)
+
+        self.parsed_expenses = []
 
 
 class ExpenseFileParser(ExpenseParser):
@@ -74,7 +96,7 @@ class VisaParser(ExpenseFileParser):
     PAYMENTS_COLUMN = 'פירוט נוסף'
     IS_PAYMENTS_KEY_1 = 'תשלומים'
     IS_PAYMENTS_KEY_2 = 'תשלום'
-    BILL_DEFAULT_DAY = 10
+    BILL_DEFAULT_DAY = BILL_CYCLE_DAY
 
     def __init__(self, filepath):
         super().__init__(filepath)
@@ -82,6 +104,8 @@ class VisaParser(ExpenseFileParser):
         card_digits = self.get_card_digits()
         self.pay_method = get_pay_method(card_digits)
         self.bill_month, self.bill_year = map(int, self.path_obj.stem.split('_'))
+        # The file is the bill of a single cycle, that starts on the pay method bill day
+        self.bill_date = datetime(self.bill_year, self.bill_month, self.pay_method.bill_day or self.BILL_DEFAULT_DAY)
 
     def get_card_digits(self):
         return self.path_obj.parts[-2]
@@ -104,12 +128,12 @@ class VisaParser(ExpenseFileParser):
             date = row[self.DATE_KEY]
             date = datetime.strptime(date, '%d/%m/%y')
             is_payments = self.check_if_payments_expense(row)
-            bill_date = datetime(self.bill_year, self.bill_month, self.BILL_DEFAULT_DAY)
 
-            self.process_new_expense(business_name, amount, date, is_payments, bill_date)
+            self.process_new_expense(business_name, amount, date, is_payments, self.bill_date)
 
     def parse_file(self):
         self.process_section()
+        self.save_new_expenses()
         return self.new_expenses, self.new_categories
 
 
@@ -186,6 +210,7 @@ class IsracardParser(ExpenseFileParser):
     def parse_file(self):
         self.process_section([self.LOCAL_EXPENSES_KEY], [self.ABROAD_EXPENSES_IN_DOLLARS_KEY, self.ABROAD_EXPENSES_KEY])
         self.process_section([self.ABROAD_IN_LOCAL_CURRENCY_EXPENSES_KEY, self.ABROAD_EXPENSES_KEY], end_keywords=None)
+        self.save_new_expenses()
 
         return self.new_expenses, self.new_categories
 
@@ -234,6 +259,7 @@ class ColuParser(ExpenseParser):
         else:
             raise Exception(f'Unknown currency. match data: {match_data}, original message: {self.message_text}')
 
+        self.save_new_expenses()
         return self.new_expenses, self.new_categories
 
 
@@ -0,0 +1,57 @@
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Timer
+from typing import Callable, Optional
+
+from slots_tracker_server import app
+
+PRECOMPUTE_MODE_ENV_NAME = 'CHARTS_PRECOMPUTE'
+# thread - recompute inside the web worker, standalone - a separate worker process recomputes, off - on request only
+THREAD_MODE = 'thread'
+STANDALONE_MODE = 'standalone'
+OFF_MODE = 'off'
+
+
+def get_precompute_mode() -> str:
+    default_mode = OFF_MODE if os.environ.get('TESTING') == 'true' else THREAD_MODE
+    return os.environ.get(PRECOMPUTE_MODE_ENV_NAME, default_mode)
+
+
+class DebouncedTask:
+    """
+    Run a function in a background thread once it was not scheduled again for `debounce` seconds,
+    a burst of schedules is never delayed more than `max_delay` seconds.
+    """
+
+    def __init__(self, func: Callable, debounce: float = 5, max_delay: float = 60):
+        self.func = func
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.timer: Optional[Timer] = None
+        self.first_scheduled: Optional[float] = None
+        self.lock = Lock()
+
+    def schedule(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if self.timer is not None and self.timer.is_alive():
+                if now - self.first_scheduled >= self.max_delay:
+                    return
+                self.timer.cancel()
+            else:
+                self.first_scheduled = now
+
+            self.timer = Timer(self.debounce, self.submit)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def submit(self) -> Future:
+        return self.executor.submit(self.run)
+
+    def run(self):
+        try:
+            return self.func()
+        except Exception as e:
+            app.logger.error(f'Background task {self.func.__name__} failed: {e}')
@@ -0,0 +1,61 @@
+from threading import Lock
+from typing import Any, Dict, List, Tuple, Type
+
+from slots_tracker_server.db import BaseDocument, CollectionVersion
+
+
+class ReferenceCache:
+    """
+    Process wide cache of the documents of the reference collections (pay methods, categories), by ID.
+    A collection is loaded again after it was invalidated, or after its version was bumped by another process.
+    """
+
+    def __init__(self):
+        self._docs: Dict[Type[BaseDocument], Tuple[int, Dict[str, Dict[str, Any]]]] = dict()
+        self._lock = Lock()
+
+    def get(self, *document_types: Type[BaseDocument]) -> List[Dict[str, Dict[str, Any]]]:
+        """The documents of each type as JSON, by ID. The documents are shared, don't change them"""
+        versions = CollectionVersion.get_versions(*[x._get_collection_name() for x in document_types])
+
+        docs_by_type = []
+        for document_type, version in zip(document_types, versions):
+            with self._lock:
+                cached_version, docs = self._docs.get(document_type, (None, None))
+
+            if cached_version != version:
+                docs = {doc['_id']: doc for doc in document_type.objects.to_json()}
+                with self._lock:
+                    self._docs[document_type] = (version, docs)
+
+            docs_by_type.append(docs)
+
+        return docs_by_type
+
+    def invalidate(self, document_type: Type[BaseDocument]) -> None:
+        with self._lock:
+            self._docs.pop(document_type, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._docs.clear()
+
+
+reference_cache = ReferenceCache()
+
+
+def expand_references(entries: List[Dict[str, Any]], document_class: Type[BaseDocument]) -> None:
+    """Replace the reference IDs of the entries (documents as JSON) with the referenced documents, in place"""
+    reference_fields = document_class.get_all_reference_fields()
+    all_docs = reference_cache.get(*[document_type for _, document_type in reference_fields])
+    for (name, document_type), docs in zip(reference_fields, all_docs):
+        ids = {str(entry[name]) for entry in entries if entry.get(name) is not None}
+        missing_ids = ids - docs.keys()
+        if missing_ids:
+            # Created after the cache was loaded, fetch all of them at once
+            docs = dict(docs)
+            docs.update((doc['_id'], doc) for doc in document_type.objects(id__in=list(missing_ids)).to_json())
+
+        for entry in entries:
+            if name in entry:
+                entry[name] = docs.get(str(entry[name])) if entry[name] is not None else None
@@ -0,0 +1,46 @@
+import json
+import os
+from datetime import datetime, timezone
+from typing import Any
+
+from bson import ObjectId, json_util
+
+from slots_tracker_server.utils import date_to_str, object_id_to_str
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND_ENV_NAME = 'JSON_BACKEND'
+ORJSON_BACKEND = 'orjson'
+
+
+def to_json_data(value: Any) -> Any:
+    """Documents (as BSON) to JSON data in one pass, ObjectIds to strings and dates to 'YYYY-MM-DD' at any depth"""
+    if isinstance(value, dict):
+        return {key: to_json_data(x) for key, x in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_data(x) for x in value]
+    if isinstance(value, ObjectId):
+        return object_id_to_str(value)
+    if isinstance(value, datetime):
+        # Dates are stored in UTC
+        return date_to_str(value.astimezone(timezone.utc) if value.tzinfo else value)
+
+    return value
+
+
+def use_orjson() -> bool:
+    return orjson is not None and os.environ.get(JSON_BACKEND_ENV_NAME) == ORJSON_BACKEND
+
+
+def dumps(data: Any) -> str:
+    """
+    The data as a JSON response, the same as json_util.dumps.
+    With JSON_BACKEND=orjson (if it is installed) the response is compact and not ASCII escaped.
+    """
+    if use_orjson():
+        return orjson.dumps(data, default=json_util.default).decode()
+
+    return json.dumps(data, default=json_util.default)
@@ -3,7 +3,12 @@ from datetime import datetime
 import pytest
 
 from slots_tracker_server import app as flask_app
-from slots_tracker_server.models import Expense, PayMethods, Categories
+from slots_tracker_server.charts import charts_cache
+from slots_tracker_server.db import CollectionVersion
+from slots_tracker_server.models import Expense, PayMethods, Categories, ExpenseRollup, BusinessNames, \
+    CategoryMatches, ChartsSnapshot, business_categories, category_matcher
+from slots_tracker_server.references import reference_cache
+from slots_tracker_server.time_index import time_indexes
 
 AMOUNT_1 = 200
 AMOUNT_2 = 500
@@ -18,6 +23,18 @@ def client():
     Expense.objects.delete()
     PayMethods.objects.delete()
     Categories.objects.delete()
+    ExpenseRollup.objects.delete()
+    BusinessNames.objects.delete()
+    CategoryMatches.objects.delete()
+    ChartsSnapshot.objects.delete()
+    CollectionVersion.objects.delete()
+    # The versions start over, nothing that was cached by them is valid
+    business_categories.clear()
+    category_matcher.clear()
+    reference_cache.clear()
+    charts_cache.clear()
+    for index in time_indexes.values():
+        index.version = None
 
     # create fake documents
     pay_method = PayMethods(name='Visa').save()
@@ -54,3 +71,7 @@ def client():
     Expense.objects.delete()
     PayMethods.objects.delete()
     Categories.objects.delete()
+    ExpenseRollup.objects.delete()
+    BusinessNames.objects.delete()
+    CategoryMatches.objects.delete()
+    ChartsSnapshot.objects.delete()
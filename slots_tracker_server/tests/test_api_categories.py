@@ -37,6 +37,32 @@ def test_no_category_is_user_added_and_not_user_added(client):
     assert all(x != y for x, y in pairs)
 
 
+def test_get_categories_etag(client):
+    rv = client.get('/categories/')
+    etag = rv.headers['ETag']
+    assert rv.status_code == 200
+
+    rv = client.get('/categories/', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.headers['ETag'] == etag
+
+    # Another list has another ETag
+    rv = client.get('/categories/?added_by_user=true', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+
+    client.post('/categories/', json={'name': 'New cat'})
+    rv = client.get('/categories/', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+
+
+def test_get_categories_fields(client):
+    rv = client.get('/categories/?fields=name')
+    r_data = json.loads(rv.get_data(as_text=True))
+    assert r_data
+    assert all(set(x) == {'_id', 'name'} for x in r_data)
+
+
 def test_get_category(client):
     category = Categories.objects[0]
     rv = client.get('/categories/{}'.format(category.id))
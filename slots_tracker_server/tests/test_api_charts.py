@@ -1,5 +1,14 @@
 import json
-from slots_tracker_server.charts import NUM_OF_CHARTS
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from slots_tracker_server.charts import NUM_OF_CHARTS, Charts, PANDAS_ENGINE, AGGREGATION_ENGINE, ROLLUPS_ENGINE, \
+    charts_cache, get_charts, get_charts_cache_key, get_charts_engine, precompute_charts
+from slots_tracker_server.bill_cycles import MAX_BILL_CYCLE_DAY
+from slots_tracker_server.models import Expense, PayMethods, ChartsSnapshot
+from slots_tracker_server.time_index import time_indexes
 
 
 # Charts
@@ -8,3 +17,93 @@ def test_get_charts(client):
     r_data = json.loads(rv.get_data(as_text=True))
     assert isinstance(r_data, list)
     assert len(r_data) == NUM_OF_CHARTS
+
+
+def test_charts_engines_match(client):
+    pandas_charts = Charts(engine=PANDAS_ENGINE).clac_charts()
+    aggregation_charts = Charts(engine=AGGREGATION_ENGINE).clac_charts()
+    rollups_charts = Charts(engine=ROLLUPS_ENGINE).clac_charts()
+    assert pandas_charts == aggregation_charts == rollups_charts
+
+
+def test_charts_engines_match_with_bill_day(client):
+    pay_method = PayMethods.objects().first()
+    pay_method.bill_day = datetime.today().day % MAX_BILL_CYCLE_DAY + 1
+    pay_method.save()
+
+    pandas_charts = Charts(engine=PANDAS_ENGINE).clac_charts()
+    aggregation_charts = Charts(engine=AGGREGATION_ENGINE).clac_charts()
+    rollups_charts = Charts(engine=ROLLUPS_ENGINE).clac_charts()
+    assert pandas_charts == aggregation_charts == rollups_charts
+
+
+def test_unsupported_charts_engine():
+    with pytest.raises(ValueError):
+        Charts(engine='xxx')
+
+
+def test_charts_cache(client):
+    key = get_charts_cache_key()
+    charts_data = get_charts()
+    assert charts_cache.get(key) == charts_data
+
+    # Any expense change creates a new cache key
+    Expense.objects.first().save()
+    assert get_charts_cache_key() != key
+
+
+def test_get_range_charts(client):
+    rv = client.get('/charts/?granularity=day&group_by=pay_method')
+    r_data = json.loads(rv.get_data(as_text=True))
+    assert len(r_data) == 1
+
+    total = sum(sum(dataset['data']) for dataset in r_data[0]['data']['datasets'])
+    assert round(total, 1) == round(Expense.objects(active=True).sum('amount'), 1)
+
+    rv = client.get('/charts/?granularity=year')
+    assert rv.status_code == 400
+
+
+def test_time_index_local_changes(client):
+    index = time_indexes['category']
+    index.build()
+    expense = Expense.objects(active=True).first()
+    expense.amount += 100
+    expense.save()
+
+    boundaries = np.array([datetime(2000, 1, 1), datetime.today() + timedelta(days=1)], dtype='datetime64[D]')
+    sums = index.get_sums(boundaries)
+    # The change was applied on top of the index, without building it again
+    assert len(index.pending) == 2
+    assert sums[str(expense.category.id)][0] == Expense.objects(active=True, category=expense.category).sum('amount')
+
+
+def test_time_index_bulk_changes(client):
+    index = time_indexes['category']
+    index.build()
+    version = index.version
+    expense = Expense.objects(active=True).first()
+    docs_data = [Expense(amount=amount, timestamp=datetime.utcnow(), pay_method=expense.pay_method,
+                         category=expense.category).to_mongo().to_dict() for amount in [10, 20]]
+    Expense.insert_many(docs_data)
+
+    # One write of two expenses, applied on top of the index
+    index.refresh()
+    assert index.version == version
+    assert len(index.pending) == 2
+
+
+def test_precompute_charts(client):
+    charts_data = precompute_charts()
+    snapshot = ChartsSnapshot.objects.get(key=str(get_charts_cache_key()))
+    assert snapshot.data == charts_data
+    assert ChartsSnapshot.get_latest(get_charts_engine()).key == snapshot.key
+
+
+def test_charts_snapshot_store():
+    ChartsSnapshot.store(key='old', engine=PANDAS_ENGINE, data='old')
+    ChartsSnapshot.store(key='other engine', engine=AGGREGATION_ENGINE, data='other')
+    ChartsSnapshot.store(key='new', engine=PANDAS_ENGINE, data='new')
+
+    assert ChartsSnapshot.get_latest(PANDAS_ENGINE).data == 'new'
+    assert sorted(x.key for x in ChartsSnapshot.objects()) == ['new', 'other engine']
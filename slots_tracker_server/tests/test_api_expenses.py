@@ -1,8 +1,12 @@
 from datetime import datetime
 import json
+from unittest.mock import patch
 
-from slots_tracker_server.api.expenses import ExpenseAPI
-from slots_tracker_server.models import Expense, PayMethods, Categories
+import pytest
+
+from slots_tracker_server.api.expenses import ExpenseAPI, NEXT_CURSOR_HEADER
+from slots_tracker_server.models import Expense, PayMethods, Categories, BusinessNames
+from slots_tracker_server.references import reference_cache
 from slots_tracker_server.tests.conftest import AMOUNT_1, AMOUNT_3, EXPENSES_WITH_AMOUNT_3
 from slots_tracker_server.utils import clean_api_object
 
@@ -17,6 +21,98 @@ def test_get_expenses(client):
         assert all(isinstance(x[name], dict) for x in r_data)
 
 
+def test_get_expenses_reference_cache(client):
+    categories, = reference_cache.get(Categories)
+    assert reference_cache.get(Categories)[0] is categories
+
+    category = Categories.objects[0]
+    client.put('/categories/{}'.format(category.id), json={'name': 'Renamed cat'})
+    assert reference_cache.get(Categories)[0] is not categories
+
+    rv = client.get('/expenses/')
+    r_data = json.loads(rv.get_data(as_text=True))
+    assert all(x['category']['name'] == 'Renamed cat' for x in r_data if x['category']['_id'] == str(category.id))
+
+
+def test_get_expenses_not_expanded(client):
+    rv = client.get('/expenses/?expand=false')
+    r_data = json.loads(rv.get_data(as_text=True))
+    assert r_data
+    for name, _ in ExpenseAPI.api_class.get_all_reference_fields():
+        assert all(isinstance(x[name], str) for x in r_data)
+
+
+def test_get_expenses_etag(client):
+    rv = client.get('/expenses/')
+    etag = rv.headers['ETag']
+
+    rv = client.get('/expenses/', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+
+    # Changing a reference changes the expenses response
+    category = Categories.objects[0]
+    client.put('/categories/{}'.format(category.id), json={'name': 'Renamed cat'})
+    rv = client.get('/expenses/', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+
+
+def test_get_expenses_fields(client):
+    rv = client.get('/expenses/?fields=amount,timestamp,category.name')
+    r_data = json.loads(rv.get_data(as_text=True))
+    assert r_data
+    assert all(set(x) == {'_id', 'amount', 'timestamp', 'category'} for x in r_data)
+    assert all(set(x['category']) == {'_id', 'name'} for x in r_data)
+
+    rv = client.get('/expenses/{}?fields=amount'.format(r_data[0]['_id']))
+    assert set(json.loads(rv.get_data(as_text=True))[0]) == {'_id', 'amount'}
+
+
+def test_get_expenses_unknown_field(client):
+    rv = client.get('/expenses/?fields=amount,not_a_field')
+    assert rv.status_code == 400
+
+
+def test_get_expenses_pages(client):
+    expenses_ids = []
+    rv = client.get('/expenses/?limit=2')
+    while True:
+        r_data = json.loads(rv.get_data(as_text=True))
+        assert len(r_data) <= 2
+        expenses_ids.extend(x['_id'] for x in r_data)
+
+        cursor = rv.headers.get(NEXT_CURSOR_HEADER)
+        if not cursor:
+            break
+        rv = client.get(f'/expenses/?limit=2&cursor={cursor}')
+
+    assert len(expenses_ids) == len(set(expenses_ids)) == Expense.objects(active=True).count()
+
+
+def test_get_expenses_pages_without_one_time(client):
+    # Expenses that were added before one_time
+    expense = Expense.objects(active=True).first()
+    for _ in range(3):
+        expense_data = expense.to_mongo().to_dict()
+        del expense_data['_id'], expense_data['one_time']
+        Expense._get_collection().insert_one(expense_data)
+
+    expenses_ids = []
+    rv = client.get('/expenses/?limit=1')
+    while True:
+        expenses_ids.extend(x['_id'] for x in json.loads(rv.get_data(as_text=True)))
+        cursor = rv.headers.get(NEXT_CURSOR_HEADER)
+        if not cursor:
+            break
+        rv = client.get(f'/expenses/?limit=1&cursor={cursor}')
+
+    assert len(expenses_ids) == len(set(expenses_ids)) == Expense.objects(active=True).count()
+
+
+def test_get_expenses_invalid_page(client):
+    assert client.get('/expenses/?limit=0').status_code == 400
+    assert client.get('/expenses/?cursor=xxx').status_code == 400
+
+
 def test_get_expense(client):
     expense = Expense.objects[0]
     rv = client.get('/expenses/{}'.format(expense.id))
@@ -84,6 +180,160 @@ def test_get_expense_404(client):
 #         assert r == expected_data
 #
 
+def test_range_filters_expenses(client):
+    rv = client.get(f'/expenses/?amount_min={AMOUNT_1}&amount_max={AMOUNT_3}')
+    data = json.loads(rv.get_data(as_text=True))
+    assert len(data) == 1 + EXPENSES_WITH_AMOUNT_3
+
+    today = datetime.utcnow().date()
+    rv = client.get(f'/expenses/?timestamp_from={today}&timestamp_to={today}&amount_max={AMOUNT_1}')
+    assert len(json.loads(rv.get_data(as_text=True))) == 1
+    rv = client.get('/expenses/?timestamp_to=2000-01-01')
+    assert json.loads(rv.get_data(as_text=True)) == []
+
+    rv = client.get('/expenses/?amount_min=not_a_number')
+    assert rv.status_code == 400
+
+
+def test_in_list_filters_expenses(client):
+    pay_methods_ids = ','.join(str(x.id) for x in PayMethods.objects())
+    rv = client.get(f'/expenses/?pay_method={pay_methods_ids}')
+    data = json.loads(rv.get_data(as_text=True))
+    assert len(data) == Expense.objects(active=True).count()
+
+
+def test_business_name_prefix_filter_expenses(client):
+    pay_method = PayMethods.objects().first()
+    category = Categories.objects().first()
+    for business_name in ['Super market', 'Super pharm', 'The super']:
+        Expense(amount=10, pay_method=pay_method, timestamp=datetime.utcnow(), category=category,
+                business_name=business_name).save()
+
+    rv = client.get('/expenses/?business_name_prefix=Super')
+    data = json.loads(rv.get_data(as_text=True))
+    assert sorted(x['business_name'] for x in data) == ['Super market', 'Super pharm']
+
+
+@pytest.fixture()
+def business_name_expenses():
+    pay_method = PayMethods.objects().first()
+    category = Categories.objects().first()
+    for business_name in ['Super-Market Tel Aviv', 'SUPER PHARM', 'מגה בעיר', 'ריעב הגמ', 'Market']:
+        Expense(amount=10, pay_method=pay_method, timestamp=datetime.utcnow(), category=category,
+                business_name=business_name).save()
+
+
+def test_search_expenses(client, business_name_expenses):
+    rv = client.get('/expenses/search?q=super mar')
+    assert [x['business_name'] for x in json.loads(rv.get_data(as_text=True))] == ['Super-Market Tel Aviv']
+
+    rv = client.get('/expenses/search?q=super&limit=1')
+    assert len(json.loads(rv.get_data(as_text=True))) == 1
+    rv = client.get('/expenses/search?q=super&cursor={}'.format(rv.headers[NEXT_CURSOR_HEADER]))
+    assert len(json.loads(rv.get_data(as_text=True))) == 1
+
+    # Reversed Hebrew
+    rv = client.get('/expenses/search?q=מגה')
+    assert sorted(x['business_name'] for x in json.loads(rv.get_data(as_text=True))) == ['מגה בעיר', 'ריעב הגמ']
+
+
+def test_search_expenses_many_business_names(client, business_name_expenses):
+    # More business names than one query takes, the expenses of each batch of names are merged
+    with patch('slots_tracker_server.api.expenses.MAX_SEARCH_BUSINESS_NAMES', 1):
+        expenses_ids = []
+        rv = client.get('/expenses/search?q=super&limit=1')
+        while True:
+            expenses_ids.extend(x['_id'] for x in json.loads(rv.get_data(as_text=True)))
+            cursor = rv.headers.get(NEXT_CURSOR_HEADER)
+            if not cursor:
+                break
+            rv = client.get(f'/expenses/search?q=super&limit=1&cursor={cursor}')
+
+        assert sorted(x.business_name for x in Expense.objects(id__in=expenses_ids)) == \
+            ['SUPER PHARM', 'Super-Market Tel Aviv']
+
+        rv = client.get('/expenses/search?q=מגה')
+        assert sorted(x['business_name'] for x in json.loads(rv.get_data(as_text=True))) == ['מגה בעיר', 'ריעב הגמ']
+
+
+def test_rebuild_business_names(client):
+    expense = Expense(amount=10, pay_method=PayMethods.objects().first(), timestamp=datetime.utcnow(),
+                      category=Categories.objects().first(), business_name='Super pharm').save()
+    BusinessNames.add(['Not used'])
+
+    assert BusinessNames.rebuild() == 1
+    assert [x.name for x in BusinessNames.objects()] == ['Super pharm']
+
+    expense.active = False
+    expense.save()
+    assert BusinessNames.rebuild() == 0
+    assert not BusinessNames.objects()
+
+
+def test_search_expenses_without_text(client):
+    rv = client.get('/expenses/search?q=')
+    assert rv.status_code == 400
+
+
+def test_get_expenses_summary(client):
+    rv = client.get('/expenses/summary?group_by=category')
+    summary = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+
+    for category in Categories.objects():
+        amounts = [x.amount for x in Expense.objects(active=True, category=category)]
+        category_summary = [x for x in summary if x['category'] == str(category.id)]
+        if amounts:
+            assert category_summary[0]['total'] == pytest.approx(sum(amounts))
+            assert category_summary[0]['count'] == len(amounts)
+            assert category_summary[0]['max'] == max(amounts)
+        else:
+            assert category_summary == []
+
+
+def test_get_expenses_summary_dates(client):
+    pay_method = PayMethods.objects().first()
+    category = Categories.objects().first()
+    for day, amount in [(1, 10), (2, 20), (3, 40)]:
+        Expense(amount=amount, pay_method=pay_method, timestamp=datetime(2000, 1, day, 12), category=category).save()
+
+    rv = client.get('/expenses/summary?from=2000-01-01&to=2000-01-02&group_by=day')
+    summary = json.loads(rv.get_data(as_text=True))
+    assert summary == [{'day': '2000-01-01', 'total': 10, 'count': 1, 'min': 10, 'max': 10, 'average': 10},
+                       {'day': '2000-01-02', 'total': 20, 'count': 1, 'min': 20, 'max': 20, 'average': 20}]
+
+
+def test_get_expenses_summary_invalid(client):
+    rv = client.get('/expenses/summary?group_by=amount')
+    assert rv.status_code == 400
+
+
+def test_post_bulk_expenses(client):
+    pay_method = PayMethods.objects().first()
+    category = Categories.objects().first()
+    expenses_count = Expense.objects.count()
+
+    expense_data = {'amount': 100, 'pay_method': str(pay_method.id), 'timestamp': '2018-05-01T00:00:00',
+                    'category': category.to_json()}
+    data = [expense_data, {'amount': 'NaN amount'}, expense_data, {**expense_data, 'category': str(pay_method.id)}]
+    rv = client.post('/expenses/bulk', json=data)
+    result = json.loads(rv.get_data(as_text=True))
+
+    assert rv.status_code == 201
+    assert [x['status'] for x in result] == [201, 400, 201, 400]
+    assert [x['index'] for x in result] == [0, 1, 2, 3]
+    assert result[0]['expense']['amount'] == 100
+    assert result[0]['expense']['category']['_id'] == str(category.id)
+    assert Expense.objects.count() == expenses_count + 2
+    assert PayMethods.objects.get(id=pay_method.id).instances == pay_method.instances + 2
+    assert Categories.objects.get(id=category.id).instances == category.instances + 2
+
+
+def test_post_bulk_expenses_invalid(client):
+    rv = client.post('/expenses/bulk', json={'amount': 100})
+    assert rv.status_code == 400
+
+
 def test_delete_expense(client):
     expense = Expense(amount=200, pay_method=PayMethods.objects().first(),
                       timestamp=datetime.utcnow(), category=Categories.objects().first()).save()
@@ -244,6 +494,34 @@ def test_post_expenses_with_payments(client):
     assert len(result) == payments
 
 
+def test_expenses_installments_group(client):
+    amount, timestamp, active, one_time = test_expense()
+    pay_method = PayMethods.objects().first()
+    category = Categories.objects().first()
+    data = {'amount': 90, 'pay_method': pay_method.to_json(), 'timestamp': '2018-01-31',
+            'category': category.to_json(), 'active': active, 'one_time': one_time}
+
+    rv = client.post('/expenses/?payments=3', json=data)
+    result = json.loads(rv.get_data(as_text=True))
+    group_id = result[0]['group_id']
+    assert [x['timestamp'] for x in result] == ['2018-01-31', '2018-02-28', '2018-03-31']
+    assert all(x['group_id'] == group_id and x['amount'] == 30 for x in result)
+
+    rv = client.get(f'/expenses/?group_id={group_id}')
+    assert len(json.loads(rv.get_data(as_text=True))) == 3
+
+    update_data = {**result[1], 'amount': 40}
+    rv = client.put('/expenses/{}?group=true'.format(result[1]['_id']), json=update_data)
+    group_expenses = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert [x['timestamp'] for x in group_expenses] == ['2018-01-31', '2018-02-28', '2018-03-31']
+    assert all(x['amount'] == 40 for x in group_expenses)
+
+    rv = client.delete('/expenses/{}?group=true'.format(result[0]['_id']))
+    assert rv.status_code == 200
+    assert Expense.objects(group_id=group_id, active=True).count() == 0
+
+
 def test_expense():
     return 100, datetime.utcnow(), True, False
 
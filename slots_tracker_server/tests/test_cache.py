@@ -0,0 +1,30 @@
+from unittest.mock import patch
+
+from slots_tracker_server.cache import TTLCache
+
+
+def test_cache_max_size():
+    cache = TTLCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # Use 'a', so 'b' is the least recently used
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_cache_ttl():
+    cache = TTLCache(ttl=10)
+    with patch('slots_tracker_server.cache.time.monotonic', return_value=100):
+        cache.set('a', 1)
+
+    with patch('slots_tracker_server.cache.time.monotonic', return_value=105):
+        assert cache.get('a') == 1
+
+    with patch('slots_tracker_server.cache.time.monotonic', return_value=111):
+        assert cache.get('a', default=False) is False
+    assert len(cache) == 0
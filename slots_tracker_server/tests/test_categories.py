@@ -1,6 +1,9 @@
+from unittest.mock import patch
+
 import pytest
 
-from slots_tracker_server.models import Categories
+from slots_tracker_server.matcher import KeywordMatcher
+from slots_tracker_server.models import Categories, CategoryMatches
 
 
 @pytest.fixture(scope="function", autouse=True)
@@ -56,3 +59,88 @@ def test_is_business_name_in_list():
     assert Categories.is_business_name_in_list(test_list, 'xcv', )
     assert not Categories.is_business_name_in_list(test_list, 'xxx')
     assert Categories.is_business_name_in_list(test_list, 'vcx')
+
+
+def test_keyword_matcher():
+    matcher = KeywordMatcher({'she': 1, 'he': 2, 'hers': 0, 'his': 3})
+    assert matcher.find_first('ushers') == 0
+    assert matcher.find_first('ushe') == 1
+    assert matcher.find_first('this') == 3
+    assert matcher.find_first('xyz') is None
+    assert KeywordMatcher(dict()).find_first('xyz') is None
+
+
+def test_guess_new_category(categories):
+    assert Categories.guess_new_category('new business') is False
+
+    categories['user_added_categories'].businesses.append('business')
+    categories['user_added_categories'].save()
+    assert Categories.guess_new_category('New Business') == categories['user_added_categories'].name
+    assert Categories.guess_new_category('ssenisub') == categories['user_added_categories'].name
+    assert Categories.guess_new_category('colu') is None
+
+
+def test_guess_new_categories():
+    with patch.object(Categories, 'get_version', wraps=Categories.get_version) as get_version:
+        assert Categories.guess_new_categories(['eatmeat 1', 'new business', 'paypal', 'eatmeat 2']) == {
+            'eatmeat 1': 'Eating out', 'new business': False, 'paypal': None, 'eatmeat 2': 'Eating out'}
+        assert get_version.call_count == 1
+
+
+def test_business_name_category_matches(categories):
+    category, _ = Categories.get_or_create_category_by_business_name('eatmeat tel aviv')
+    assert category.name == 'Eating out'
+    assert CategoryMatches.objects.get(business_name='eatmeat tel aviv').guessed
+
+    # Changing the businesses removes the guessed matches
+    categories['user_added_categories'].businesses.append('tel aviv')
+    categories['user_added_categories'].save()
+    assert not CategoryMatches.objects(business_name='eatmeat tel aviv')
+    category, _ = Categories.get_or_create_category_by_business_name('eatmeat tel aviv')
+    assert category.name == 'Eating out'
+
+    # Merging removes the matches of the merged category
+    new_category, is_new = Categories.get_or_create_category_by_business_name('new shop')
+    assert is_new
+    new_category.merge_categories(categories['user_added_categories'].id)
+    assert not CategoryMatches.objects(business_name='new shop')
+    category, is_new = Categories.get_or_create_category_by_business_name('new shop')
+    assert category.name == categories['user_added_categories'].name
+    assert not is_new
+
+
+def test_get_or_create_categories_by_business_names():
+    results = Categories.get_or_create_categories_by_business_names(
+        ['new shop 1', 'new shop 2', 'eatmeat', 'Cat 1', 'paypal', 'new shop 1'])
+    assert {name: (category and category.name, is_new) for name, (category, is_new) in results.items()} == {
+        'new shop 1': ('new shop 1', True), 'new shop 2': ('new shop 2', True), 'eatmeat': ('Eating out', False),
+        'Cat 1': ('Cat 1', False), 'paypal': (False, False)}
+    assert not Categories.objects.get(name='new shop 1').added_by_user
+
+    # Created by a parallel import, so not new here
+    Categories.create_not_user_added(['new shop 3'])
+    category, is_new = Categories.get_or_create_category_by_business_name('new shop 3')
+    assert category.name == 'new shop 3'
+    assert not is_new
+    assert Categories.objects(name='new shop 3').count() == 1
+
+
+def test_business_name_categories_cache_versions():
+    category, _ = Categories.get_or_create_category_by_business_name('new shop')
+
+    # Merged by another process, the cached category is not used
+    Categories._get_collection().delete_one({'_id': category.pk})
+    CategoryMatches.objects(category=category.pk).delete()
+    new_category, is_new = Categories.get_or_create_category_by_business_name('new shop')
+    assert new_category.pk != category.pk
+    assert is_new
+
+
+def test_business_name_categories_cache_counters():
+    category, _ = Categories.get_or_create_category_by_business_name('new shop')
+
+    # Counters changes don't remove the cached categories
+    Categories.objects(id=category.pk).update(inc__instances=1)
+    with patch.object(CategoryMatches, '_get_collection') as get_collection:
+        assert Categories.get_or_create_category_by_business_name('new shop') == (category, False)
+        get_collection.assert_not_called()
@@ -1,3 +1,8 @@
+from datetime import datetime
+from unittest.mock import patch
+
+from pymongo.errors import BulkWriteError
+
 from slots_tracker_server.models import Expense, PayMethods, Categories
 from slots_tracker_server.tests.test_utils import DEFAULT_DATE_NEW_OBJECT
 
@@ -11,3 +16,41 @@ def test_new_expenses():
     expense.category = Categories.objects().first()
     expense.save()
     assert not Expense.is_new_expense(expense)
+
+
+def test_upsert_expenses():
+    pay_method = PayMethods.objects().first()
+    category = Categories.objects().first()
+    instances = category.instances
+
+    def get_docs_data():
+        return [Expense(amount=amount, timestamp=datetime(2000, 1, 1), pay_method=pay_method, category=category,
+                        business_name=business_name).to_mongo().to_dict()
+                for amount, business_name in [(10, 'Super Market'), (10, 'super  market'), (10, 'Pharm'), (20, 'Pharm')]]
+
+    docs_data = get_docs_data()
+    assert Expense.upsert_many(docs_data) == [True, False, True, True]
+    assert docs_data[0]['fingerprint'] == docs_data[1]['fingerprint']
+    assert Expense.objects(id=docs_data[0]['_id']).count() == 1
+    assert category.reload().instances == instances + 3
+
+    # Imported again
+    assert Expense.upsert_many(get_docs_data()) == [False, False, False, False]
+    assert Expense.objects(timestamp=datetime(2000, 1, 1)).count() == 3
+
+
+def test_upsert_expenses_parallel_import():
+    pay_method = PayMethods.objects().first()
+    category = Categories.objects().first()
+    instances = category.instances
+    docs_data = [Expense(amount=amount, timestamp=datetime(2000, 1, 1), pay_method=pay_method, category=category,
+                         business_name='Pharm').to_mongo().to_dict() for amount in [10, 20]]
+
+    # The first expense is inserted by another import between its upsert and the insert
+    error = BulkWriteError({'writeErrors': [{'index': 0, 'code': 11000}], 'upserted': [{'index': 1, '_id': 'id'}]})
+    with patch.object(Expense, '_get_collection') as get_collection:
+        get_collection.return_value.bulk_write.side_effect = error
+        assert Expense.upsert_many(docs_data) == [False, True]
+    assert docs_data[1]['_id'] == 'id'
+    assert category.reload().instances == instances + 1
+
@@ -0,0 +1,13 @@
+from slots_tracker_server.indexes import build_indexes, explain_queries
+from slots_tracker_server.models import Expense
+
+
+def test_build_indexes():
+    indexes = build_indexes()
+    assert 'group_id_1' in indexes[Expense._get_collection_name()]
+
+
+def test_queries_use_indexes():
+    build_indexes()
+    collection_scans = [name for name, is_collection_scan, _ in explain_queries() if is_collection_scan]
+    assert collection_scans == []
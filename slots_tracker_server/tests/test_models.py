@@ -1,9 +1,11 @@
 from datetime import datetime
+from unittest.mock import patch
 
 import pytest
 from mongoengine.errors import FieldDoesNotExist, ValidationError
 
-from slots_tracker_server.models import Expense, PayMethods, Categories
+from slots_tracker_server.counters import CounterBuffer
+from slots_tracker_server.models import Expense, PayMethods, Categories, ExpenseRollup
 
 
 def test_field_does_not_exist():
@@ -24,5 +26,88 @@ def test_save():
     Expense(amount=200, pay_method=pay_method, timestamp=datetime.utcnow,
             category=category).save()
 
-    assert pay_method.instances == pay_method_instances + 1
-    assert category.instances == category_instances + 1
+    assert pay_method.reload().instances == pay_method_instances + 1
+    assert category.reload().instances == category_instances + 1
+
+
+def test_rollups():
+    pay_method = PayMethods.objects().first()
+    category = Categories.objects().first()
+    timestamp = datetime(2020, 3, 5)
+    rollup_key = ExpenseRollup.get_key(timestamp, category.id, pay_method.id)
+
+    expense = Expense(amount=200, pay_method=pay_method, timestamp=timestamp, category=category).save()
+    rollup = ExpenseRollup.objects.get(**rollup_key)
+    assert rollup.cycle == datetime(2020, 2, 10)
+    assert rollup.amount == 200
+    assert rollup.count == 1
+
+    expense.update(amount=100, pay_method=pay_method.id, category=category.id)
+    assert rollup.reload().amount == 100
+
+    expense.reload()
+    expense.active = False
+    expense.save()
+    assert rollup.reload().count == 0
+
+    incremental_rollups = {(x.cycle, x.month, x.category.id, x.pay_method.id): (x.amount, x.count)
+                           for x in ExpenseRollup.objects(count__gt=0)}
+    ExpenseRollup.rebuild()
+    rebuilt_rollups = {(x.cycle, x.month, x.category.id, x.pay_method.id): (x.amount, x.count)
+                       for x in ExpenseRollup.objects()}
+    assert incremental_rollups == rebuilt_rollups
+
+
+def test_to_frame():
+    expenses = Expense.objects(active=True)
+    frame = expenses.to_frame('timestamp', 'amount', 'category', 'pay_method')
+
+    assert list(frame.columns) == ['timestamp', 'amount', 'category', 'pay_method']
+    assert len(frame) == expenses.count()
+    assert frame.timestamp.dtype.kind == 'M'
+    assert frame.amount.dtype == float
+    assert frame.category.dtype.name == 'category'
+    assert set(frame.category) == {str(x.category.id) for x in expenses}
+    assert frame.amount.sum() == expenses.sum('amount')
+
+
+def test_counter_buffer():
+    category = Categories.objects().first()
+    instances = category.instances
+    buffer = CounterBuffer(interval=60)
+    buffer.add(Categories, category.id, 2)
+    buffer.add(Categories, category.id, 1)
+    assert len(buffer) == 1
+    assert category.reload().instances == instances
+
+    assert buffer.flush() == 1
+    assert len(buffer) == 0
+    assert category.reload().instances == instances + 3
+
+
+def test_counter_buffer_failed_write():
+    category = Categories.objects().first()
+    instances = category.instances
+    buffer = CounterBuffer(interval=60)
+    buffer.add(Categories, category.id, 2)
+
+    with patch.object(Categories, '_get_collection') as get_collection:
+        get_collection.return_value.bulk_write.side_effect = Exception('Write failed')
+        assert buffer.flush() == 0
+    # The changes are kept for the next flush
+    assert len(buffer) == 1
+
+    buffer.add(Categories, category.id, 1)
+    assert buffer.flush() == 1
+    assert category.reload().instances == instances + 3
+
+
+def test_reconcile_reference_count():
+    category = Categories.objects().first()
+    Categories.objects(id=category.id).update(instances=999)
+    actual_count = Expense.objects(category=category.id).count()
+
+    drifts = Expense.reconcile_reference_count(fix=True)
+    assert ('Categories', category.id, 999, actual_count) in drifts
+    assert category.reload().instances == actual_count
+    assert Expense.reconcile_reference_count() == []
@@ -4,7 +4,7 @@ import pytest
 from pytest import raises
 
 from slots_tracker_server.utils import BASEDIR
-from slots_tracker_server.models import PayMethods
+from slots_tracker_server.models import PayMethods, Expense, Categories, CategoryMatches, business_categories
 from slots_tracker_server.parser import IsracardParser, VisaParser, get_parser_from_file_path
 
 FIRST_SECTION_START_INX = 24
@@ -50,6 +50,22 @@ def test_parse_file():
     assert len(new_categories) == TOTAL_NEW_CATEGORIES_VISA
 
 
+def test_parse_file_existing_expenses():
+    parser = get_parser_from_file_path(ISRACARD_FILEPATH)
+    parser.parse_file()
+
+    # Expenses imported before the fingerprints, without the categories that were created for them
+    Expense.objects.update(unset__fingerprint=True)
+    Categories.objects(added_by_user=False).delete()
+    CategoryMatches.objects.delete()
+    business_categories.clear()
+
+    parser = get_parser_from_file_path(ISRACARD_FILEPATH)
+    new_expenses, new_categories = parser.parse_file()
+    assert len(new_categories) == len(new_expenses) == 0
+    assert not Categories.objects(added_by_user=False)
+
+
 def test_many_pay_methods_with_same_digits():
     PayMethods(name='new pay 1234').save()
     with raises(Exception):
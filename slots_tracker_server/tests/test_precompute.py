@@ -0,0 +1,25 @@
+import time
+
+from slots_tracker_server.precompute import DebouncedTask
+
+
+def test_debounced_task():
+    calls = []
+    task = DebouncedTask(lambda: calls.append(1), debounce=0.2)
+    for _ in range(5):
+        task.schedule()
+    assert not calls
+
+    time.sleep(0.5)
+    assert len(calls) == 1
+
+
+def test_debounced_task_max_delay():
+    calls = []
+    task = DebouncedTask(lambda: calls.append(1), debounce=0.2, max_delay=0.3)
+    # Without max delay the task would run only after the schedules stop
+    for _ in range(20):
+        task.schedule()
+        time.sleep(0.05)
+
+    assert calls
@@ -0,0 +1,25 @@
+from datetime import datetime, timezone, timedelta
+
+from bson import ObjectId, json_util
+
+from slots_tracker_server.serializer import to_json_data, dumps
+
+VALID_ID = '5b5c8a2b2c88848042426dff'
+
+
+def test_to_json_data_nested():
+    data = {'_id': ObjectId(VALID_ID), 'timestamp': datetime(2018, 5, 1, 13, 30),
+            'items': [{'category': ObjectId(VALID_ID), 'dates': [datetime(2018, 5, 2)]}], 'name': 'name'}
+
+    assert to_json_data(data) == {'_id': VALID_ID, 'timestamp': '2018-05-01',
+                                  'items': [{'category': VALID_ID, 'dates': ['2018-05-02']}], 'name': 'name'}
+
+
+def test_to_json_data_utc_date():
+    timestamp = datetime(2018, 5, 2, 1, 0, tzinfo=timezone(timedelta(hours=3)))
+    assert to_json_data(timestamp) == '2018-05-01'
+
+
+def test_dumps_compatible():
+    data = [{'_id': VALID_ID, 'name': 'שם', 'amount': 33.333333333333336, 'active': True, 'business_name': None}]
+    assert dumps(data) == json_util.dumps(data)
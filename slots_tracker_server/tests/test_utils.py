@@ -1,13 +1,15 @@
 import os
 from datetime import datetime
 
+import numpy as np
 import pytest
 from unittest.mock import patch
 from bson import ObjectId
 from werkzeug.exceptions import BadRequest
 
+from slots_tracker_server.bill_cycles import BillCycles, assign_bill_cycles
 from slots_tracker_server.utils import convert_to_object_id, find_and_convert_object_id, find_and_convert_date, \
-    get_bill_cycles, next_payment_date, is_prod, ENV_NAME, PROD_ENV_NAME
+    get_bill_cycles, next_payment_date, payment_dates, business_name_tokens, is_prod, ENV_NAME, PROD_ENV_NAME
 
 VALID_ID = '5b5c8a2b2c88848042426dff'
 INVALID_ID = '5b5c8a2b2c88848042426dffa'
@@ -122,6 +124,12 @@ def test_next_payment_date():
     assert next_payment_date(date, payment=3) == datetime(2019, 1, 29)
 
 
+def test_payment_dates():
+    for date in [datetime(2018, 1, 31), datetime(2018, 10, 29, 13, 45, 10), datetime(2020, 2, 29)]:
+        date = str(date)
+        assert payment_dates(date, 36) == [next_payment_date(date, payment=i) for i in range(36)]
+
+
 def test_is_prod():
     with patch.dict(os.environ, {ENV_NAME: PROD_ENV_NAME}):
         assert is_prod()
@@ -130,3 +138,26 @@ def test_is_prod():
 
 
 # TODO: add tests for remove_new_lines
+
+
+def test_bill_cycles():
+    with pytest.raises(ValueError):
+        BillCycles(bill_day=31)
+
+    bill_cycles = BillCycles(bill_day=2)
+    assert bill_cycles.get_cycles(datetime(2018, 1, 1)) == (datetime(2017, 11, 2), datetime(2017, 12, 1),
+                                                             datetime(2017, 12, 2), datetime(2018, 1, 1))
+
+    timestamps = np.array([datetime(2018, 1, 1), datetime(2018, 1, 2, 10), datetime(2018, 3, 31)],
+                          dtype='datetime64[ms]')
+    expected_cycles = np.array(['2017-12-02', '2018-01-02', '2018-03-02'], dtype='datetime64[D]')
+    assert (bill_cycles.assign(timestamps) == expected_cycles).all()
+
+    cycles = assign_bill_cycles(timestamps, pay_methods=['a', 'b', 'a'], bill_days={'b': 2})
+    expected_cycles = np.array(['2017-12-10', '2018-01-02', '2018-03-10'], dtype='datetime64[D]')
+    assert (cycles == expected_cycles).all()
+
+
+def test_business_name_tokens():
+    assert business_name_tokens('Super-Market  Tel.Aviv') == ['aviv', 'market', 'super', 'tel']
+    assert business_name_tokens('מגה market') == ['market', 'הגמ', 'מגה']
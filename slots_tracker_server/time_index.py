@@ -0,0 +1,104 @@
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, Any
+
+import numpy as np
+import pandas as pd
+
+from slots_tracker_server.models import Expense, EXPENSE_CHANGE_LISTENERS
+
+GROUP_BY_FIELDS = ['category', 'pay_method', 'business_name']
+MAX_PENDING_CHANGES = 1000
+
+
+class DailyIndex:
+    """
+    Cumulative sums of the active expenses amounts, by group and day.
+    The amount of a group between two days is the difference between two lookups in the cumulative sums.
+    """
+
+    def __init__(self, group_by: str):
+        self.group_by = group_by
+        self.version: Optional[int] = None
+        # Changes made by this process since the index was built, applied on top of the index
+        self.local_changes = 0
+        self.pending: List[Tuple[str, np.datetime64, float]] = []
+
+        self.groups: List[str] = []
+        self.first_day = np.datetime64('today', 'D')
+        self.days_range = 1
+        self.keys = np.empty(0, dtype=np.int64)
+        self.cumsum = np.zeros(1)
+        self.lock = Lock()
+
+    def build(self):
+        version = Expense.get_version()
+        data = Expense.objects(active=True).to_frame('timestamp', 'amount', self.group_by)
+
+        column = data[self.group_by]
+        if column.dtype.name != 'category':
+            column = column.fillna('')
+        groups = pd.Categorical(column)
+        codes = groups.codes.astype(np.int64)
+        days = data.timestamp.values.astype('datetime64[D]')
+        amounts = data.amount.values
+
+        valid = codes >= 0
+        codes, days, amounts = codes[valid], days[valid], amounts[valid]
+
+        # Each group days are a continuous block of keys: group code * days range + day number
+        self.first_day = days.min() if len(days) else np.datetime64('today', 'D')
+        day_numbers = (days - self.first_day).astype(np.int64)
+        self.days_range = int(day_numbers.max()) + 2 if len(days) else 1
+        keys = codes * self.days_range + day_numbers
+        order = np.argsort(keys, kind='stable')
+
+        self.keys = keys[order]
+        self.cumsum = np.concatenate([[0.0], np.cumsum(amounts[order])])
+        self.groups = [str(x) for x in groups.categories]
+        self.version = version
+        self.local_changes = 0
+        self.pending = []
+
+    def refresh(self):
+        # Rebuild only if someone else changed the expenses, or there are too many local changes
+        version = Expense.get_version()
+        if self.version is None or version != self.version + self.local_changes or \
+                len(self.pending) > MAX_PENDING_CHANGES:
+            self.build()
+
+    def apply_changes(self, changes: List[Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]]):
+        with self.lock:
+            if self.version is None:
+                return
+
+            # Each write bumps the expenses version once, whatever the number of expenses it changed
+            self.local_changes += 1
+            for old_data, new_data in changes:
+                for expense_data, sign in [(old_data, -1), (new_data, 1)]:
+                    if expense_data and expense_data.get('active', True):
+                        group = expense_data.get(self.group_by)
+                        group = '' if group is None else str(group)
+                        day = np.datetime64(expense_data['timestamp'], 'D')
+                        self.pending.append((group, day, sign * float(expense_data['amount'])))
+
+    def get_sums(self, boundaries: np.ndarray) -> Dict[str, np.ndarray]:
+        """Amount of each group between each two consecutive days in boundaries (datetime64[D])"""
+        with self.lock:
+            self.refresh()
+
+            day_numbers = np.clip((boundaries - self.first_day).astype(np.int64), 0, self.days_range - 1)
+            group_keys = np.arange(len(self.groups), dtype=np.int64)[:, None] * self.days_range + day_numbers
+            prefix_sums = self.cumsum[np.searchsorted(self.keys, group_keys)]
+            sums = np.diff(prefix_sums, axis=1)
+            group_sums = {group: sums[i] for i, group in enumerate(self.groups)}
+
+            for group, day, amount in self.pending:
+                bucket = np.searchsorted(boundaries, day, side='right') - 1
+                if 0 <= bucket < len(boundaries) - 1:
+                    group_sums.setdefault(group, np.zeros(len(boundaries) - 1))[bucket] += amount
+
+            return group_sums
+
+
+time_indexes = {name: DailyIndex(name) for name in GROUP_BY_FIELDS}
+EXPENSE_CHANGE_LISTENERS.extend(index.apply_changes for index in time_indexes.values())
@@ -1,8 +1,12 @@
+import base64
+import re
+import numpy as np
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
-from typing import Tuple, Dict, Any, Union, Type
+from typing import Tuple, Dict, Any, Union, Type, Optional, List
 
+from bson import json_util
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
 from dateutil.parser import parse
@@ -11,7 +15,9 @@ from flask import abort
 from flask.views import MethodView
 
 from slots_tracker_server import app
+from slots_tracker_server.bill_cycles import BillCycles
 
+HEBREW_LETTERS = re.compile('[\u0590-\u05ff]')
 BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
 ENV_NAME = 'FLASK_ENV'
 PROD_ENV_NAME = 'production'
@@ -60,48 +66,67 @@ def clean_api_object(obj_data: Dict[str, Any]) -> None:
         del obj_data['_id']
 
 
-def get_bill_cycles(today: datetime) -> Tuple[datetime, datetime, datetime, datetime]:
-    # Case 4: 1-1-18
-    if today.month == 1 and today.day < 10:
-        previous_month, previous_year = 11, today.year - 1
-        middle_month, middle_year = 12, today.year - 1
-        next_month, next_year = 1, today.year
-    # Case 5 and Case 2: 10-1-18, 1-2-18
-    elif (today.month == 2 and today.day < 10) or (today.month == 1 and today.day >= 10):
-        previous_month, previous_year = 12, today.year - 1
-        middle_month, middle_year = 1, today.year
-        next_month, next_year = 2, today.year
-
-    # Case 6: 10-12-18
-    elif today.month == 12 and today.day >= 10:
-        previous_month, previous_year = 11, today.year
-        middle_month, middle_year = 12, today.year
-        next_month, next_year = 1, today.year + 1
-    else:
-        # Case 3: 1-9-18, 1-12-18
-        if today.day < 10:
-            previous_month, previous_year = today.month - 2, today.year
-            middle_month, middle_year = today.month - 1, today.year
-            next_month, next_year = today.month, today.year
-
-        # Case 1: 10-11-18, 21-2-18, 21-11-18, 12-2-18
-        else:
-            previous_month, previous_year = today.month - 1, today.year
-            middle_month, middle_year = today.month, today.year
-            next_month, next_year = today.month + 1, today.year
-
-    start_cycle1 = datetime(previous_year, previous_month, 10)
-    end_cycle1 = datetime(middle_year, middle_month, 9)
-    start_cycle2 = datetime(middle_year, middle_month, 10)
-    end_cycle2 = datetime(next_year, next_month, 9)
-
-    return start_cycle1, end_cycle1, start_cycle2, end_cycle2
+def encode_cursor(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        values = None
+
+    if not isinstance(values, list) or len(values) != size:
+        abort(400, '{} is not a valid cursor'.format(cursor))
+
+    return values
+
+
+def get_bill_cycles(today: datetime, bill_day: Optional[int] = None) -> Tuple[datetime, datetime, datetime, datetime]:
+    return BillCycles(bill_day).get_cycles(today)
+
+
+def get_bill_cycle_start(date: datetime, bill_day: Optional[int] = None) -> datetime:
+    return BillCycles(bill_day).get_cycle_start(date)
+
+
+def start_of_day(date: datetime) -> datetime:
+    return datetime(date.year, date.month, date.day)
+
+
+def next_day(date: datetime) -> datetime:
+    # Expenses are compared by date only, so "until the end of the day" is "before the next midnight"
+    return start_of_day(date) + timedelta(days=1)
 
 
 def next_payment_date(current_date: str, payment: int = 1) -> datetime:
     return parse(current_date) + relativedelta(months=+payment)
 
 
+def payment_dates(first_date: str, payments: int) -> List[datetime]:
+    """The dates of all the monthly payments at once, same as next_payment_date for each payment"""
+    first = parse(first_date)
+    naive_first = first.replace(tzinfo=None)
+    months = np.datetime64(naive_first, 'M') + np.arange(payments)
+    # Clip the day to the last day of shorter months
+    days_in_month = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+    days = np.minimum(naive_first.day, days_in_month) - 1
+    time_of_day = np.datetime64(naive_first, 'us') - np.datetime64(naive_first, 'D')
+    dates = months.astype('datetime64[D]') + days.astype('timedelta64[D]') + time_of_day
+
+    return [x.replace(tzinfo=first.tzinfo) for x in dates.astype('datetime64[us]').tolist()]
+
+
+def normalize_words(text: str) -> List[str]:
+    return re.findall(r'\w+', text.lower())
+
+
+def business_name_tokens(business_name: str) -> List[str]:
+    """The normalized words of a business name, Hebrew words also reversed (the statements may have them reversed)"""
+    words = normalize_words(business_name)
+    return sorted(set(words) | {x[::-1] for x in words if HEBREW_LETTERS.search(x)})
+
+
 def is_prod():
     return os.environ[ENV_NAME] == PROD_ENV_NAME
 
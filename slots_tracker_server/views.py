@@ -5,11 +5,12 @@ from flask import request
 
 from slots_tracker_server import app, sentry
 from slots_tracker_server.api.expenses import ExpenseAPI, PayMethodsAPI, CategoriesAPI
-from slots_tracker_server.charts import Charts
+from slots_tracker_server.charts import get_charts, get_range_charts, RANGE_CHART_ARGS, schedule_charts_precompute
 from slots_tracker_server.notifications import Notifications
 from slots_tracker_server.utils import register_api, remove_new_lines
 
 BACKUPS = os.path.join('/tmp', 'backups')
+WRITE_METHODS = ['POST', 'PUT', 'DELETE']
 
 
 @app.route('/')
@@ -19,14 +20,39 @@ def home_page():
 
 @app.route('/charts/')
 def charts():
-    chart = Charts()
-    return chart.clac_charts()
+    if any(x in request.args for x in RANGE_CHART_ARGS):
+        return get_range_charts(request.args)
+
+    return get_charts()
+
+
+@app.route('/expenses/bulk', methods=['POST'])
+def bulk_expenses():
+    return ExpenseAPI().post_bulk()
+
+
+@app.route('/expenses/summary')
+def expenses_summary():
+    return ExpenseAPI().get_summary()
+
+
+@app.route('/expenses/search')
+def search_expenses():
+    return ExpenseAPI().search()
+
+
+@app.after_request
+def precompute_charts_after_write(response):
+    if request.method in WRITE_METHODS and response.status_code < 400:
+        schedule_charts_precompute()
+
+    return response
 
 
 @app.route('/monthly_update/')
 def monthly_update():
     res = None
-    charts_data = charts()
+    charts_data = get_charts()
 
     if charts_data:
         charts_as_json = json.loads(charts_data)